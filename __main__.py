@@ -1,13 +1,16 @@
 #!/bin/env python3
-from util import setup, get_args, add_uri_to_file
+import tracing
+from util import setup, get_args
 
 
 def add_uri_command(args):
+    from util import favorites_file, my_playlists_file, add_uris_to_file
+
     add_to_pls = args.use_playlists
     add_to_favs = not add_to_pls or args.use_favorites
-    uris = args.uris
+    uris = []
 
-    for uri in uris:
+    for uri in args.uris:
         if uri in ('c', 'context'):
             from util import get_current_playback
             from spotify_item import SpotifyItem
@@ -20,19 +23,67 @@ def add_uri_command(args):
 
         if add_to_pls:
             from util import get_uri_type
-            if (get_uri_type(uri) == "playlist"):
-                add_uri_to_file(my_playlists_file, uri)
-            else:
+            if (get_uri_type(uri) != "playlist"):
                 raise Exception(f"Could not add uri to playlists: {uri} is not a playlist!")
-        if add_to_favs:
-            add_uri_to_file(favorites_file, uri)
+        uris.append(uri)
 
+    if add_to_pls:
+        add_uris_to_file(my_playlists_file, uris)
+    if add_to_favs:
+        add_uris_to_file(favorites_file, uris)
 
-if __name__ == '__main__':
-    setup()
 
-    args = get_args()
+def cache_command(args):
+    import metadata_cache
+    import thumbnails
+
+    if args.compact:
+        thumbnails.compact()
+    if args.warm:
+        import catalogue
+        from spotify_item import Favorites
+        from util import favorites_file, my_playlists_file
+
+        items = [item for file_path in (favorites_file, my_playlists_file) for item in Favorites.from_file(file_path)]
+        images = [(item.get_img_url(), item.uri) for item in items]
+        images += [(track.get_img_url(), None) for track, thumb in catalogue.get_tracks() if thumb]
+        thumbnails.warm([(img_url, uri) for img_url, uri in images if img_url])
+
+    stats = metadata_cache.get_stats()
+    lookups = stats['hits'] + stats['misses']
+    hit_rate = stats['hits'] / lookups if lookups else 0
+    print(f"Metadata cache: {stats['entries']} entries, {stats['hits']} hits, {stats['misses']} misses "
+          f"({hit_rate:.0%} hit rate)")
+
+    stats = thumbnails.get_stats()
+    lookups = stats['hits'] + stats['misses']
+    hit_rate = stats['hits'] / lookups if lookups else 0
+    print(f"Image cache: {stats['files']}/{stats['max_files']} files, "
+          f"{stats['bytes'] / 2 ** 20:.1f}/{stats['max_bytes'] / 2 ** 20:.1f}MiB, "
+          f"{stats['hits']} hits, {stats['misses']} misses ({hit_rate:.0%} hit rate)")
+
+
+def run(args):
+    import metadata_cache
+    import search_index
+    import thumbnails
 
+    metadata_cache.cache_only = args.cache_only
+    if args.trace:
+        tracing.begin(args.action)
+    try:
+        run_action(args)
+    finally:
+        # the daemon lets downloads finish in the background instead of holding up the next request
+        if not tracing.in_daemon:
+            thumbnails.wait_for_fetches()
+        metadata_cache.flush()
+        thumbnails.flush()
+        search_index.flush()
+        tracing.end()
+
+
+def run_action(args):
     action = args.action
 
     if action == "p" or action is None:
@@ -41,10 +92,41 @@ if __name__ == '__main__':
     elif action == "s":
         from menus import save_menu
         save_menu()
+    elif action == "t":
+        from menus import track_menu
+        track_menu()
     elif action == "a":
-        from util import favorites_file, my_playlists_file
         add_uri_command(args=args)
     elif action == "sp":
         from menus import add_to_playlist_menu
         from util import my_playlists_file, get_current_track
-        add_to_playlist_menu(my_playlists_file, get_current_track())
\ No newline at end of file
+        add_to_playlist_menu(my_playlists_file, get_current_track())
+    elif action == "cache":
+        cache_command(args)
+
+
+if __name__ == '__main__':
+    import sys
+    from daemon import client_actions, forward
+
+    # hand the request to a running daemon if there is one, skipping all heavy imports in this process
+    if not sys.argv[1:] or sys.argv[1] in client_actions:
+        status = forward(sys.argv[1:])
+        if status is not None:
+            sys.exit(status)
+
+    setup()
+
+    args = get_args()
+
+    if args.action == "daemon":
+        from daemon import serve, stop
+        if args.stop:
+            stop()
+        else:
+            serve(run)
+    elif args.action == "watch":
+        from mpris_watcher import watch
+        watch(args.address)
+    else:
+        run(args)
@@ -0,0 +1,53 @@
+# asyncio layer over the spotipy client, so independent Web API requests can run concurrently
+# every spotipy method is available as a coroutine, e.g. await client.playlist_items(uri, offset=100)
+# calls run on a thread pool sized to the concurrency cap and share the client's auth and HTTP session
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+
+class AsyncSpotify:
+
+    def __init__(self, spotify, max_concurrency: int = 8):
+        self.spotify = spotify
+        self.max_concurrency = max_concurrency
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="spotify")
+
+    def __getattr__(self, name):
+        method = getattr(self.spotify, name)
+
+        async def call(*args, **kwargs):
+            return await asyncio.get_running_loop().run_in_executor(self._executor, partial(method, *args, **kwargs))
+
+        return call
+
+    # yields the items of each page of an offset-paginated endpoint, in order
+    # the first page gives the total, then up to window pages are requested ahead of the one being yielded
+    # pages still in flight when the consumer stops early are cancelled
+    async def iter_pages(self, method: str, *args, limit: int = 100, window: int = None, **kwargs):
+        import collections
+        call = getattr(self, method)
+        first = await call(*args, limit=limit, offset=0, **kwargs)
+        yield first['items']
+        # the server may serve smaller pages than asked for, the page says which limit it applied
+        limit = first.get('limit') or limit
+        offsets = iter(range(limit, first['total'], limit))
+        pending = collections.deque()
+        try:
+            while True:
+                while len(pending) < (window or self.max_concurrency):
+                    offset = next(offsets, None)
+                    if offset is None:
+                        break
+                    pending.append(asyncio.ensure_future(call(*args, limit=limit, offset=offset, **kwargs)))
+                if not pending:
+                    return
+                yield (await pending.popleft())['items']
+        finally:
+            for task in pending:
+                task.cancel()
+
+    # fetches the first page of an offset-paginated endpoint, then every remaining page concurrently
+    # returns the items of all pages in order
+    async def get_all_items(self, method: str, *args, limit: int = 100, **kwargs):
+        return [item async for page in self.iter_pages(method, *args, limit=limit, **kwargs) for item in page]
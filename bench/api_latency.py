@@ -0,0 +1,33 @@
+#!/bin/env python3
+# Compares the latency of the first (cold: new TCP/TLS connection) and later (warm: pooled keep-alive connection)
+# Web API calls, using util.request_hooks. Uses the configured account, or the [Api] prefix if one is set.
+# usage: api_latency.py [calls]
+import statistics
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import util  # noqa: E402
+
+if __name__ == '__main__':
+    calls = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+    timings = []
+    util.request_hooks.append(lambda response: timings.append((response.request.method, response.url,
+                                                               response.elapsed.total_seconds())))
+    util.setup()
+    spotify = util.get_spotify()
+    # make sure a token refresh doesn't land inside the measured calls
+    spotify.auth_manager.get_access_token(as_dict=False)
+    timings.clear()
+
+    for _ in range(calls):
+        spotify.current_user()
+
+    cold = timings[0][2]
+    warm = [elapsed for _, _, elapsed in timings[1:]]
+    print(f"cold: {cold * 1000:7.1f}ms")
+    if warm:
+        print(f"warm: {statistics.median(warm) * 1000:7.1f}ms median over {len(warm)} calls "
+              f"(min {min(warm) * 1000:.1f}ms, max {max(warm) * 1000:.1f}ms)")
@@ -0,0 +1,326 @@
+# Local stand-ins for the services PlayMenu talks to, so menus can be benchmarked without a Spotify account,
+# a display or the Spotify desktop client:
+#   StubApi       a Web API HTTP server with configurable latency and page size, serving generated items
+#   FakeRofi      a scripted replacement for the rofi module
+#   FakeMpris     the Spotify MPRIS object, served through a replacement dbus module
+# Items are generated from their ids (tr12 is track 12, al1 its album), so any id the menus ask for exists.
+import json
+import re
+import sys
+import threading
+import types
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from time import perf_counter, sleep
+from urllib.parse import urlparse, parse_qs
+
+# tracks in a playlist, and saved tracks, are tr0..tr{size - 1}
+tracks_per_album = 10
+albums_per_artist = 10
+
+
+def _id_number(item_id: str):
+    return int(item_id[2:]) if item_id[2:].isdigit() else 0
+
+
+def image_data(base_url: str, item_id: str):
+    return [{'url': f"{base_url}/image/{item_id}", 'width': width, 'height': width} for width in (640, 300, 64)]
+
+
+def artist_data(base_url: str, item_id: str):
+    return {'uri': f"spotify:artist:{item_id}", 'name': f"Artist {item_id}", 'images': image_data(base_url, item_id)}
+
+
+def album_data(base_url: str, item_id: str):
+    artist_id = f"ar{_id_number(item_id) // albums_per_artist}"
+    return {'uri': f"spotify:album:{item_id}", 'name': f"Album {item_id}",
+            'artists': [{'uri': f"spotify:artist:{artist_id}", 'name': f"Artist {artist_id}"}],
+            'images': image_data(base_url, item_id)}
+
+
+def track_data(base_url: str, item_id: str):
+    album = album_data(base_url, f"al{_id_number(item_id) // tracks_per_album}")
+    return {'uri': f"spotify:track:{item_id}", 'name': f"Track {item_id}", 'artists': album['artists'],
+            'album': album}
+
+
+def playlist_data(base_url: str, item_id: str, snapshot_id: str = None):
+    return {'uri': f"spotify:playlist:{item_id}", 'name': f"Playlist {item_id}",
+            'owner': {'display_name': "Bench"}, 'images': image_data(base_url, item_id),
+            'snapshot_id': snapshot_id}
+
+
+item_data = {"track": track_data, "album": album_data, "artist": artist_data, "playlist": playlist_data}
+
+
+def file_entry(base_url: str, uri: str):
+    _, item_type, item_id = uri.split(":")
+    data = item_data[item_type](base_url, item_id)
+    if item_type == "playlist":
+        artists = [data['owner']['display_name']]
+    else:
+        artists = [artist['name'] for artist in data.get('artists', [])]
+    return "\t".join((item_type, data['name'], ",".join(artists), uri)) + "\n"
+
+
+def _make_jpeg():
+    from PIL import Image
+    out = BytesIO()
+    Image.new("RGB", (300, 300), (30, 215, 96)).save(out, "JPEG")
+    return out.getvalue()
+
+
+class StubApi(ThreadingHTTPServer):
+    daemon_threads = True
+
+    # latency: seconds added to every response, page_size: the most items served per page
+    def __init__(self, port: int = 0, latency: float = 0.02, page_size: int = 100):
+        super().__init__(("127.0.0.1", port), _Handler)
+        self.latency = latency
+        self.page_size = page_size
+        self.base_url = f"http://127.0.0.1:{self.server_port}"
+        self.jpeg = _make_jpeg()
+        self._lock = threading.Lock()
+        self.calls = Counter()
+        self.reset(0)
+
+    @property
+    def prefix(self):
+        return f"{self.base_url}/v1/"
+
+    # size: tracks in every playlist and in the saved tracks library
+    def reset(self, size: int):
+        with self._lock:
+            self.size = size
+            self.saved = [f"spotify:track:tr{i}" for i in range(size)]
+            self.saved_set = set(self.saved)
+            self.playlist_additions = {}
+            self.calls.clear()
+
+    # the calls counted since the last time they were taken
+    def take_calls(self):
+        with self._lock:
+            calls = dict(self.calls)
+            self.calls.clear()
+        return calls
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="stub-api", daemon=True).start()
+        return self
+
+    def count(self, endpoint: str):
+        with self._lock:
+            self.calls[endpoint] += 1
+
+    # uri_at(i) gives the uri at index i, so pages of large playlists are made without listing every uri
+    def page(self, total: int, uri_at, query: dict, minimal: bool):
+        limit = min(int(query.get('limit', ["20"])[0]), self.page_size)
+        offset = int(query.get('offset', ["0"])[0])
+        items = []
+        for i in range(offset, min(offset + limit, total)):
+            uri = uri_at(i)
+            items.append({'track': {'uri': uri} if minimal else track_data(self.base_url, uri.rsplit(":", 1)[1])})
+        return {'items': items, 'total': total, 'limit': limit, 'offset': offset}
+
+    def playlist_page(self, playlist_id: str, query: dict, minimal: bool):
+        added = self.playlist_additions.get(playlist_id, [])
+        return self.page(self.size + len(added),
+                         lambda i: f"spotify:track:tr{i}" if i < self.size else added[i - self.size], query, minimal)
+
+    def snapshot_id(self, playlist_id: str):
+        return f"{playlist_id}-{len(self.playlist_additions.get(playlist_id, []))}"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: StubApi
+
+    # endpoints are counted with ids replaced, e.g. GET /v1/playlists/{id}/items
+    _ids = re.compile(r"/(tr|al|ar|pl)\d+")
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.handle_request("HEAD")
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_PUT(self):
+        self.handle_request("PUT")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_DELETE(self):
+        self.handle_request("DELETE")
+
+    def handle_request(self, method: str):
+        url = urlparse(self.path)
+        path = url.path.rstrip("/")
+        query = parse_qs(url.query)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b""
+
+        is_image = path.startswith("/image/")
+        self.server.count("image" if is_image else f"{method} {self._ids.sub('/{id}', path)}")
+        sleep(self.server.latency)
+
+        if is_image:
+            return self.send(200, self.server.jpeg, "image/jpeg")
+        try:
+            status, data = self.route(method, path.split("/")[2:], query, body)
+        except (KeyError, ValueError, IndexError) as e:
+            status, data = 400, {'error': {'status': 400, 'message': str(e)}}
+        self.send(status, json.dumps(data).encode() if data is not None else b"", "application/json")
+
+    def send(self, status: int, payload: bytes, content_type: str):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(payload)
+
+    def route(self, method: str, parts: list, query: dict, body: bytes):
+        server = self.server
+        base_url = server.base_url
+        if not parts:
+            return 200, None
+
+        # multi-id endpoints: tracks/?ids=a,b
+        if parts[0] in ("tracks", "albums", "artists") and len(parts) == 1:
+            ids = query['ids'][0].split(",")
+            return 200, {parts[0]: [item_data[parts[0][:-1]](base_url, item_id) for item_id in ids]}
+        if parts[0] in ("tracks", "albums", "artists"):
+            return 200, item_data[parts[0][:-1]](base_url, parts[1])
+
+        if parts[0] == "playlists":
+            playlist_id = parts[1]
+            if len(parts) == 2:
+                return 200, playlist_data(base_url, playlist_id, server.snapshot_id(playlist_id))
+            if method == "POST":
+                added = json.loads(body)
+                uris = added['uris'] if isinstance(added, dict) else added
+                with server._lock:
+                    server.playlist_additions.setdefault(playlist_id, []).extend(uris)
+                return 201, {'snapshot_id': server.snapshot_id(playlist_id)}
+            minimal = "items(track(uri))" in query.get('fields', [""])[0]
+            return 200, server.playlist_page(playlist_id, query, minimal)
+
+        if parts[:2] == ["me", "tracks"]:
+            return 200, server.page(len(server.saved), server.saved.__getitem__, query, False)
+        if parts[:2] == ["me", "library"]:
+            uris = query['uris'][0].split(",")
+            if len(parts) == 3:
+                return 200, [uri in server.saved_set for uri in uris]
+            with server._lock:
+                for uri in uris:
+                    if method == "PUT" and uri not in server.saved_set:
+                        server.saved.insert(0, uri)
+                        server.saved_set.add(uri)
+                    elif method == "DELETE" and uri in server.saved_set:
+                        server.saved.remove(uri)
+                        server.saved_set.discard(uri)
+            return 200, None
+        if parts[:2] == ["me", "player"]:
+            if len(parts) > 2:
+                return 204, None
+            return 200, {'item': track_data(base_url, current_track_id(server.size)),
+                         'context': {'uri': "spotify:playlist:pl0"}}
+
+        return 404, {'error': {'status': 404, 'message': "Unknown endpoint"}}
+
+
+# the playing track, which is in neither the library nor any playlist until the menus add it
+def current_track_id(size: int):
+    return f"tr{size}"
+
+
+class FakeRofi:
+    """Stands in for rofi.Rofi. Each select pops the next scripted answer, either an (index, key) tuple, an
+    (indices, key) tuple for -multi-select, or a function of the options returning one; every menu shown is
+    recorded with when it was shown. Answers go through _run_blocking as rofi's exit code and output, like
+    python-rofi's, so wrappers of it see what rofi would print."""
+
+    answers = []
+    entries = []
+    shown = []
+    # seconds each menu stays open, like a user reading it
+    dwell = 0
+
+    def __init__(self, rofi_args=None, **kwargs):
+        self.rofi_args = rofi_args
+
+    def select(self, prompt, options, message="", select=None, **kwargs):
+        FakeRofi.shown.append({'prompt': prompt, 'rows': len(options), 'at': perf_counter()})
+        sleep(FakeRofi.dwell)
+        returncode, stdout = self._run_blocking(["rofi", "-dmenu", "-p", prompt, "-format", "i"], options)
+        return int(stdout) if stdout else -1, {0: 0, 1: -1}.get(returncode, returncode - 9)
+
+    def _run_blocking(self, args, input=None):
+        answer = FakeRofi.answers.pop(0) if FakeRofi.answers else (-1, 0)
+        index, key = answer(input) if callable(answer) else answer
+        indices = index if isinstance(index, list) else [index] if index != -1 else []
+        return {0: 0, -1: 1}.get(key, key + 9), "\n".join(map(str, indices))
+
+    def text_entry(self, prompt, message=None, allow_blank=False, strip=True, **kwargs):
+        FakeRofi.shown.append({'prompt': prompt, 'rows': 0, 'at': perf_counter()})
+        return FakeRofi.entries.pop(0) if FakeRofi.entries else None
+
+    @staticmethod
+    def escape(string):
+        from html import escape
+        return escape(string, quote=False)
+
+    @staticmethod
+    def script(*answers, entries=()):
+        FakeRofi.answers = list(answers)
+        FakeRofi.entries = list(entries)
+        FakeRofi.shown = []
+
+
+class FakeMpris:
+    """The org.mpris.MediaPlayer2.spotify object: Metadata describes the playing track and OpenUri records
+    what was played."""
+
+    def __init__(self, base_url: str, size: int):
+        track = track_data(base_url, current_track_id(size))
+        self.metadata = {
+            'mpris:trackid': track['uri'],
+            'mpris:artUrl': track['album']['images'][0]['url'],
+            'xesam:title': track['name'],
+            'xesam:album': track['album']['name'],
+            'xesam:albumArtist': [artist['name'] for artist in track['album']['artists']],
+            'xesam:artist': [artist['name'] for artist in track['artists']],
+        }
+        self.opened = []
+
+    def Get(self, interface, prop, dbus_interface=None):
+        if prop != "Metadata":
+            raise KeyError(prop)
+        return self.metadata
+
+    def OpenUri(self, uri):
+        self.opened.append(uri)
+
+
+def install(mpris: FakeMpris):
+    """Replaces the rofi and dbus modules with the fakes, before anything imports them."""
+    rofi = types.ModuleType("rofi")
+    rofi.Rofi = FakeRofi
+    sys.modules["rofi"] = rofi
+
+    class SessionBus:
+        def get_object(self, bus_name, object_path):
+            return mpris
+
+    dbus = types.ModuleType("dbus")
+    dbus.SessionBus = SessionBus
+    dbus.String = str
+    dbus.Array = list
+    dbus.Interface = lambda obj, interface: obj
+    dbus.PROPERTIES_IFACE = "org.freedesktop.DBus.Properties"
+    sys.modules["dbus"] = dbus
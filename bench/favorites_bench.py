@@ -0,0 +1,75 @@
+#!/bin/env python3
+# Measures Favorites load, add and reorder costs and the memory held by the loaded items.
+# usage: favorites_bench.py [size ...]   (defaults to 10000 100000)
+import random
+import sys
+import tempfile
+import tracemalloc
+from pathlib import Path
+from time import perf_counter
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from spotify_item import Favorites, SpotifyItem  # noqa: E402
+
+item_types = ("playlist", "album", "artist", "track")
+
+
+def make_entry(i: int):
+    item_type = item_types[i % len(item_types)]
+    return SpotifyItem.from_file_entry(f"{item_type}\tName {i}\tArtist {i},Artist {i + 1}\tspotify:{item_type}:{i:022d}")
+
+
+def bench(size: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "favorites.txt"
+        Favorites([make_entry(i) for i in range(size)]).write(path)
+
+        start = perf_counter()
+        favs = Favorites.from_file(path)
+        load_time = perf_counter() - start
+
+        # measured on a second load, tracing allocations slows loading down
+        del favs
+        tracemalloc.start()
+        favs = Favorites.from_file(path)
+        memory, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    new_items = [make_entry(i) for i in range(size, size + 1000)]
+    start = perf_counter()
+    for item in new_items:
+        favs.add_item(item)
+    add_time = (perf_counter() - start) / len(new_items)
+
+    # re-adding existing uris exercises dedup
+    start = perf_counter()
+    for item in new_items:
+        favs.add_item(item)
+    dedup_time = (perf_counter() - start) / len(new_items)
+
+    targets = random.sample(favs.items, 1000)
+    start = perf_counter()
+    for item in targets:
+        favs.bring_to_top(item)
+    reorder_time = (perf_counter() - start) / len(targets)
+
+    start = perf_counter()
+    for item in targets:
+        favs.remove_item(item)
+    remove_time = (perf_counter() - start) / len(targets)
+
+    print(f"{size:>7} items: load {load_time * 1000:8.1f}ms  memory {memory / 2 ** 20:6.1f}MiB  "
+          f"add {add_time * 1e6:5.2f}us  dedup {dedup_time * 1e6:5.2f}us  "
+          f"reorder {reorder_time * 1e6:5.2f}us  remove {remove_time * 1e6:5.2f}us")
+
+
+if __name__ == '__main__':
+    import builtins
+    # remove_item logs every removal
+    _print = builtins.print
+    builtins.print = lambda *args, **kwargs: None if args and str(args[0]).startswith("Removing") \
+        else _print(*args, **kwargs)
+
+    for size in map(int, sys.argv[1:] or (10000, 100000)):
+        bench(size)
@@ -0,0 +1,70 @@
+#!/bin/env python3
+# Reports import time per entry point and fails if a budget is exceeded or a heavy dependency is
+# imported before the entry point actually needs it.
+# usage: import_budget.py [budget_ms]
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+repo_dir = Path(__file__).resolve().parent.parent
+
+# modules that must only be imported on the code paths that use them
+heavy_modules = ("spotipy", "PIL", "dbus", "googlesearch", "rofi", "requests")
+
+# modules each action imports before doing any work
+entry_points = {
+    "p": ("menus", "spotify_item"),
+    "s": ("menus", "spotify_item"),
+    "sp": ("menus", "spotify_item"),
+    "t": ("menus", "spotify_item", "catalogue"),
+    "a": ("spotify_item",),
+}
+
+# runs the top of __main__ (without dispatching) and the action's imports in a fresh interpreter
+probe = """
+import json, runpy, sys
+from time import perf_counter
+start = perf_counter()
+runpy.run_path("__main__.py", run_name="probe")
+for module in {modules!r}:
+    __import__(module)
+elapsed = perf_counter() - start
+print(json.dumps({{"elapsed": elapsed, "heavy": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def measure(modules: tuple):
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", probe.format(modules=modules, heavy=heavy_modules)],
+                            cwd=repo_dir, capture_output=True, text=True, check=True)
+    report = json.loads(result.stdout.splitlines()[-1])
+
+    # "import time: self [us] | cumulative | imported package", top level imports only
+    slowest = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not name.startswith("  "):
+            slowest.append((int(cumulative), name.strip()))
+    report['slowest'] = sorted(slowest, reverse=True)[:5]
+    return report
+
+
+if __name__ == '__main__':
+    budget = float(sys.argv[1]) / 1000 if len(sys.argv) > 1 else 0.05
+
+    failed = False
+    for action, modules in entry_points.items():
+        report = measure(modules)
+        over_budget = report['elapsed'] > budget
+        failed |= over_budget or bool(report['heavy'])
+
+        status = "FAIL" if over_budget or report['heavy'] else "ok"
+        print(f"{action:>3}: {report['elapsed'] * 1000:6.1f}ms (budget {budget * 1000:.0f}ms) {status}")
+        if report['heavy']:
+            print(f"     heavy modules imported: {', '.join(report['heavy'])}")
+        for cumulative, name in report['slowest']:
+            print(f"     {cumulative / 1000:6.1f}ms {name}")
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,114 @@
+#!/bin/env python3
+# Compares launches of the real entry point (__main__.py p, s, sp, t) run directly, importing spotipy/PIL and
+# building the Spotify client in a fresh interpreter, with the same launches forwarded by the thin client to a
+# running `play-menu daemon`. Both run in a fresh home directory against the stub Web API, rofi and MPRIS of
+# fakes.py, with every menu dismissed as soon as it shows, and with caches warmed by one unmeasured launch first,
+# so the two differ only in who runs the action. Direct launches also pay for importing fakes.py, which is
+# measured and reported on its own; the thin client forwards without it.
+# usage: launch_times.py [runs] [--actions p s sp t] [--size n] [--latency ms]
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from argparse import ArgumentParser, SUPPRESS
+from pathlib import Path
+from time import perf_counter, sleep
+
+bench_dir = Path(__file__).resolve().parent
+repo_dir = bench_dir.parent
+sys.path.insert(0, str(repo_dir))
+sys.path.insert(0, str(bench_dir))
+
+
+# runs __main__.py with argv as if launched from a shell, with rofi and MPRIS replaced by the fakes
+def launch(base_url: str, size: int, argv: list):
+    import runpy
+    from fakes import FakeMpris, install
+
+    install(FakeMpris(base_url, size))
+    sys.argv = [str(repo_dir / "__main__.py"), *argv]
+    runpy.run_path(sys.argv[0], run_name="__main__")
+
+
+def time_command(command: list, runs: int):
+    times = []
+    # the first launch fills the caches
+    for _ in range(runs + 1):
+        start = perf_counter()
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+        times.append(perf_counter() - start)
+    return times[1:]
+
+
+def report(label: str, times: list):
+    print(f"{label:>12}: median {statistics.median(times) * 1000:8.1f}ms  "
+          f"min {min(times) * 1000:8.1f}ms  max {max(times) * 1000:8.1f}ms  ({len(times)} runs)")
+
+
+# runs with HOME pointing at a fresh directory
+def run_bench(runs: int, actions: list, size: int, latency: float):
+    import daemon
+    from fakes import StubApi
+    from menu_bench import write_account, seed
+
+    server = StubApi(latency=latency).start()
+    server.reset(size)
+    for parent in (".config", ".cache"):
+        (Path.home() / parent).mkdir(exist_ok=True)
+    import util
+    util.setup()
+    write_account(server)
+    seed(server, "p", size, 10)
+    seed(server, "sp", size, 10)
+
+    direct = {action: time_command([sys.executable, __file__, "--launch", server.base_url, str(size), action], runs)
+              for action in actions}
+    bare = [sys.executable, "-c", "pass"]
+    with_fakes = [sys.executable, "-c", f"import sys; sys.path.insert(0, {str(bench_dir)!r}); import fakes"]
+    harness = statistics.median(time_command(with_fakes, runs)) - statistics.median(time_command(bare, runs))
+
+    serving = subprocess.Popen([sys.executable, __file__, "--launch", server.base_url, str(size), "daemon"],
+                               stdout=subprocess.DEVNULL)
+    try:
+        while True:
+            try:
+                daemon.ping()
+                break
+            except (ConnectionError, FileNotFoundError):
+                if serving.poll() is not None:
+                    raise RuntimeError("The daemon exited before serving")
+                sleep(0.05)
+        # the thin client as launched from a shell, it never gets to rofi or MPRIS
+        forwarded = {action: time_command([sys.executable, str(repo_dir / "__main__.py"), action], runs)
+                     for action in actions}
+    finally:
+        daemon.stop()
+        serving.wait()
+
+    print(f"importing fakes.py adds {harness * 1000:.1f}ms to each direct launch")
+    for action in actions:
+        report(f"{action} direct", direct[action])
+        report(f"{action} daemon", forwarded[action])
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Benchmark launches run directly against launches served by the daemon")
+    parser.add_argument("runs", nargs="?", type=int, default=10)
+    parser.add_argument("--actions", nargs="+", default=["p", "s", "sp", "t"], choices=["p", "s", "sp", "t"])
+    parser.add_argument("--size", type=int, default=100, help="Favorites, and tracks in each of 10 playlists")
+    parser.add_argument("--latency", type=float, default=20, help="Stub Web API latency in ms")
+    parser.add_argument("--launch", nargs="+", help=SUPPRESS)
+    parser.add_argument("--bench", action="store_true", help=SUPPRESS)
+    args = parser.parse_args()
+
+    if args.launch:
+        launch(args.launch[0], int(args.launch[1]), args.launch[2:])
+        sys.exit()
+    if args.bench:
+        run_bench(args.runs, args.actions, args.size, args.latency / 1000)
+        sys.exit()
+
+    with tempfile.TemporaryDirectory() as home:
+        subprocess.run([sys.executable, __file__, str(args.runs), "--actions", *args.actions, "--size", str(args.size),
+                        "--latency", str(args.latency), "--bench"], env={**os.environ, 'HOME': home}, check=True)
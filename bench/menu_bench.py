@@ -0,0 +1,169 @@
+#!/bin/env python3
+# Measures the menus end to end against local stand-ins (see fakes.py): a stub Web API server, scripted rofi
+# answers and a fake Spotify MPRIS object. Every action runs twice in a fresh home directory, cold (empty caches)
+# and warm (caches from the cold run), reporting wall time, when rofi was first shown and the API calls made.
+#   p   play the first favorite from favorites.txt holding size items
+#   s   save the current track, with size saved tracks in the library
+#   sp  add the current track to the first of --playlists playlists holding size tracks each
+#   t   play the first track of the catalogue of --playlists playlists holding size tracks each
+#   a   add size uris to favorites.txt
+# usage: menu_bench.py [size ...] [--latency ms] [--page-size n] [--playlists n] [--dwell s] [--actions p s sp t a]
+#        (sizes default to 10 100 1000 10000 100000)
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from argparse import ArgumentParser, SUPPRESS
+from pathlib import Path
+from time import perf_counter
+
+bench_dir = Path(__file__).resolve().parent
+sys.path.insert(0, str(bench_dir.parent))
+sys.path.insert(0, str(bench_dir))
+
+item_prefixes = {"playlist": "pl", "album": "al", "artist": "ar", "track": "tr"}
+
+
+def make_uris(size: int):
+    item_types = list(item_prefixes)
+    return [f"spotify:{item_types[i % 4]}:{item_prefixes[item_types[i % 4]]}{i}" for i in range(size)]
+
+
+def write_account(server):
+    import configparser
+    from time import time
+    from util import config_file, oauth_file, scopes, write_json
+
+    config = configparser.ConfigParser()
+    config["Authentication"] = {"clientId": "bench", "clientSecret": "bench"}
+    config["Api"] = {"prefix": server.prefix}
+    with config_file.open("w") as f:
+        config.write(f)
+    write_json(oauth_file, {'access_token': "bench", 'token_type': "Bearer", 'expires_in': 3600,
+                            'refresh_token': "bench", 'scope': " ".join(sorted(scopes)),
+                            'expires_at': int(time()) + 24 * 60 * 60})
+
+
+def seed(server, action: str, size: int, playlists: int):
+    from fakes import file_entry
+    from util import favorites_file, my_playlists_file
+
+    if action == "p":
+        with favorites_file.open("w") as f:
+            f.writelines(file_entry(server.base_url, uri) for uri in make_uris(size))
+    elif action in ("sp", "t"):
+        with my_playlists_file.open("w") as f:
+            f.writelines(file_entry(server.base_url, f"spotify:playlist:pl{i}") for i in range(playlists))
+
+
+def script(action: str):
+    from fakes import FakeRofi
+
+    if action in ("p", "s", "t"):
+        # the first row: the first favorite or track, or (un)save song
+        FakeRofi.script((0, 0))
+    elif action == "sp":
+        # the first playlist, then "Yes"
+        FakeRofi.script((0, 0), (0, 0))
+    else:
+        FakeRofi.script()
+
+
+def wait_for_prefetches():
+    import threading
+    for thread in threading.enumerate():
+        if thread.name.startswith("prefetch-"):
+            thread.join()
+
+
+# runs in a child process with HOME pointing at a fresh directory, so every module level cache starts empty
+def run_child(action: str, size: int, latency: float, page_size: int, playlists: int, dwell: float):
+    import contextlib
+    import importlib.util
+    from fakes import StubApi, FakeMpris, FakeRofi, install
+
+    server = StubApi(latency=latency, page_size=page_size).start()
+    server.reset(size)
+    mpris = FakeMpris(server.base_url, size)
+    install(mpris)
+    FakeRofi.dwell = dwell
+
+    for parent in (".config", ".cache"):
+        (Path.home() / parent).mkdir(exist_ok=True)
+    import util
+    util.setup()
+    write_account(server)
+    seed(server, action, size, playlists)
+
+    notifications = []
+    util.notify_send = lambda message, image=None: notifications.append(message)
+
+    # the real entry point, so runs include the cache flushes done after every action
+    spec = importlib.util.spec_from_file_location("play_menu_main", bench_dir.parent / "__main__.py")
+    play_menu_main = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(play_menu_main)
+    argv = ["a", *make_uris(size)] if action == "a" else [action]
+
+    results = []
+    for run in ("cold", "warm"):
+        script(action)
+        notifications.clear()
+        mpris.opened.clear()
+        server.take_calls()
+
+        start = perf_counter()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            play_menu_main.run(util.get_args(argv))
+        wall = perf_counter() - start
+        wait_for_prefetches()
+
+        calls = server.take_calls()
+        images = calls.pop("image", 0)
+        results.append({'action': action, 'size': size, 'run': run, 'wall': wall,
+                        'time_to_rofi': FakeRofi.shown[0]['at'] - start if FakeRofi.shown else None,
+                        'api_calls': sum(calls.values()), 'images': images, 'calls': calls,
+                        'played': len(mpris.opened), 'notifications': len(notifications)})
+    print(json.dumps(results))
+
+
+def print_result(result: dict):
+    time_to_rofi = f"{result['time_to_rofi'] * 1000:9.1f}ms" if result['time_to_rofi'] is not None else f"{'-':>11}"
+    top = sorted(result['calls'].items(), key=lambda call: -call[1])[:3]
+    print(f"{result['action']:>2} {result['size']:>7} {result['run']:>4}  {result['wall'] * 1000:10.1f}ms "
+          f"{time_to_rofi} {result['api_calls']:>9} {result['images']:>7}  "
+          + ", ".join(f"{endpoint} x{count}" for endpoint, count in top))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Benchmark the menus against a stub Web API, rofi and MPRIS")
+    parser.add_argument("sizes", nargs="*", type=int, default=[10, 100, 1000, 10000, 100000])
+    parser.add_argument("--actions", nargs="+", default=["p", "s", "sp", "t", "a"],
+                        choices=["p", "s", "sp", "t", "a"])
+    parser.add_argument("--latency", type=float, default=20, help="Stub Web API latency in ms")
+    parser.add_argument("--page-size", type=int, default=100, help="Most items the stub serves per page")
+    parser.add_argument("--playlists", type=int, default=10, help="Playlists in my_playlists.txt for sp")
+    parser.add_argument("--dwell", type=float, default=0, help="Seconds each scripted rofi menu stays open")
+    parser.add_argument("--child", nargs=2, help=SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child[0], int(args.child[1]), args.latency / 1000, args.page_size, args.playlists, args.dwell)
+        sys.exit()
+
+    print(f"stub latency {args.latency:g}ms, page size {args.page_size}, {args.playlists} playlists, "
+          f"rofi dwell {args.dwell:g}s")
+    print(f"{'':>2} {'size':>7} {'run':>4}  {'wall':>12} {'to rofi':>11} {'api calls':>9} {'images':>7}  top endpoints")
+    for action in args.actions:
+        for size in args.sizes:
+            with tempfile.TemporaryDirectory() as home:
+                child = subprocess.run(
+                    [sys.executable, __file__, "--child", action, str(size), "--latency", str(args.latency),
+                     "--page-size", str(args.page_size), "--playlists", str(args.playlists),
+                     "--dwell", str(args.dwell)],
+                    env={**os.environ, 'HOME': home}, capture_output=True, text=True)
+            if child.returncode:
+                print(f"{action:>2} {size:>7} failed:\n{child.stderr.strip()}")
+                continue
+            for result in json.loads(child.stdout.splitlines()[-1]):
+                print_result(result)
@@ -0,0 +1,163 @@
+#!/bin/env python3
+# Runs the MPRIS watcher against a fake Spotify MPRIS service on a private dbus-daemon, in a fresh home directory
+# with the stub Web API (see fakes.py) serving the context. The service skips through tracks on Next, and every
+# skip reports how long the watcher took to write the new track and its context to player.json, next to what
+# reading the current track costs from the state file and over D-Bus.
+# needs dbus-daemon, dbus-python and PyGObject
+# usage: mpris_watch.py [skips] [--latency ms]
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from argparse import ArgumentParser, SUPPRESS
+from pathlib import Path
+from time import perf_counter, sleep
+
+bench_dir = Path(__file__).resolve().parent
+sys.path.insert(0, str(bench_dir.parent))
+sys.path.insert(0, str(bench_dir))
+
+
+# the Spotify client's MPRIS object, playing track tr{index} of the stub API
+def run_service(address: str, base_url: str):
+    import dbus
+    import dbus.service
+    from dbus.mainloop.glib import DBusGMainLoop
+    from gi.repository import GLib
+    from fakes import track_data
+
+    player_interface = "org.mpris.MediaPlayer2.Player"
+
+    class Service(dbus.service.Object):
+
+        def __init__(self, bus):
+            super().__init__(dbus.service.BusName("org.mpris.MediaPlayer2.spotify", bus), "/org/mpris/MediaPlayer2")
+            self.index = 0
+
+        def metadata(self):
+            track = track_data(base_url, f"tr{self.index}")
+            return dbus.Dictionary({
+                'mpris:trackid': track['uri'],
+                'mpris:artUrl': track['album']['images'][0]['url'],
+                'xesam:title': track['name'],
+                'xesam:album': track['album']['name'],
+                'xesam:albumArtist': dbus.Array([artist['name'] for artist in track['album']['artists']], "s"),
+                'xesam:artist': dbus.Array([artist['name'] for artist in track['artists']], "s"),
+            }, "sv")
+
+        @dbus.service.method(dbus.PROPERTIES_IFACE, in_signature="ss", out_signature="v")
+        def Get(self, interface, prop):
+            return self.GetAll(interface)[prop]
+
+        @dbus.service.method(dbus.PROPERTIES_IFACE, in_signature="s", out_signature="a{sv}")
+        def GetAll(self, interface):
+            return {'Metadata': self.metadata(), 'PlaybackStatus': "Playing"}
+
+        @dbus.service.signal(dbus.PROPERTIES_IFACE, signature="sa{sv}as")
+        def PropertiesChanged(self, interface, changed, invalidated):
+            pass
+
+        @dbus.service.method(player_interface, in_signature="", out_signature="")
+        def Next(self):
+            self.index += 1
+            self.PropertiesChanged(player_interface, {'Metadata': self.metadata()}, [])
+
+    Service(dbus.bus.BusConnection(address, mainloop=DBusGMainLoop()))
+    print("ready", flush=True)
+    GLib.MainLoop().run()
+
+
+# seconds from start until condition holds, or None on timeout
+def wait_for(condition, start: float, timeout: float = 10):
+    while not condition():
+        if perf_counter() - start > timeout:
+            return None
+        sleep(0.0005)
+    return perf_counter() - start
+
+
+def report(label: str, times: list):
+    times = [t for t in times if t is not None]
+    if not times:
+        print(f"{label:>16}: timed out")
+        return
+    print(f"{label:>16}: median {statistics.median(times) * 1000:8.3f}ms  max {max(times) * 1000:8.3f}ms  "
+          f"({len(times)} runs)")
+
+
+# runs with HOME pointing at a fresh directory
+def run_bench(address: str, skips: int, latency: float):
+    import threading
+    import dbus
+    from fakes import StubApi
+    from menu_bench import write_account
+
+    server = StubApi(latency=latency).start()
+    for parent in (".config", ".cache"):
+        (Path.home() / parent).mkdir(exist_ok=True)
+    import util
+    util.setup()
+    write_account(server)
+
+    import mpris_watcher
+    service = subprocess.Popen([sys.executable, __file__, "--service", address, server.base_url],
+                               stdout=subprocess.PIPE, text=True)
+    try:
+        service.stdout.readline()
+        threading.Thread(target=mpris_watcher.watch, args=(address,), daemon=True).start()
+        wait_for(lambda: mpris_watcher.get_metadata(), perf_counter())
+
+        bus = dbus.bus.BusConnection(address)
+        spotify = bus.get_object(mpris_watcher.bus_name, mpris_watcher.object_path)
+        track_times, context_times, state_reads, dbus_reads = [], [], [], []
+        for index in range(1, skips + 1):
+            # the Web API reports the track MPRIS switched to
+            server.size = index
+            uri = f"spotify:track:tr{index}"
+            start = perf_counter()
+            spotify.Next(dbus_interface="org.mpris.MediaPlayer2.Player")
+            track_times.append(wait_for(lambda: (mpris_watcher.get_metadata() or {}).get('mpris:trackid') == uri,
+                                        start))
+            context_times.append(wait_for(lambda: mpris_watcher.get_context_uri(uri) is not False, start))
+
+            start = perf_counter()
+            mpris_watcher.get_metadata()
+            state_reads.append(perf_counter() - start)
+            start = perf_counter()
+            spotify.Get("org.mpris.MediaPlayer2.Player", "Metadata", dbus_interface=dbus.PROPERTIES_IFACE)
+            dbus_reads.append(perf_counter() - start)
+
+        report("track in state", track_times)
+        report("context in state", context_times)
+        report("read state file", state_reads)
+        report("D-Bus Get", dbus_reads)
+    finally:
+        service.terminate()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Benchmark the MPRIS watcher against a fake Spotify on a private bus")
+    parser.add_argument("skips", nargs="?", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=20, help="Stub Web API latency in ms")
+    parser.add_argument("--service", nargs=2, help=SUPPRESS)
+    parser.add_argument("--bench", help=SUPPRESS)
+    args = parser.parse_args()
+
+    if args.service:
+        run_service(*args.service)
+        sys.exit()
+    if args.bench:
+        run_bench(args.bench, args.skips, args.latency / 1000)
+        sys.exit()
+
+    # a private bus, so the bench never sees or disturbs a real Spotify client
+    bus = subprocess.run(["dbus-daemon", "--session", "--fork", "--print-address=1", "--print-pid=1"],
+                         capture_output=True, text=True, check=True).stdout.split()
+    address, pid = bus[0], int(bus[1])
+    try:
+        with tempfile.TemporaryDirectory() as home:
+            subprocess.run([sys.executable, __file__, str(args.skips), "--latency", str(args.latency),
+                            "--bench", address], env={**os.environ, 'HOME': home})
+    finally:
+        os.kill(pid, 15)
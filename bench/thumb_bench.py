@@ -0,0 +1,81 @@
+#!/bin/env python3
+# Measures thumbnail decode throughput in images per second on generated 640px JPEG covers, without network:
+# a full decode resized to 64px (the pipeline before draft decoding), util.save_thumbnails for one and for
+# several sizes, and save_thumbnails on a process pool as used by thumbnails.warm.
+# usage: thumb_bench.py [images] [--sizes 64 128] [--processes n]
+import multiprocessing
+import os
+import sys
+import tempfile
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from pathlib import Path
+from time import perf_counter
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from util import save_thumbnails  # noqa: E402
+
+
+# a cover with some detail, so encoded size and decode cost are close to real album art
+def make_cover(i: int, size: int = 640):
+    from PIL import Image, ImageDraw
+
+    img = Image.linear_gradient("L").resize((size, size)).convert("RGB")
+    draw = ImageDraw.Draw(img)
+    for j in range(12):
+        x, y = (i * 37 + j * 101) % size, (i * 53 + j * 67) % size
+        draw.ellipse((x, y, x + size // 4, y + size // 5), fill=((i * 13 + j * 40) % 256, (j * 90) % 256, i % 256))
+    data = BytesIO()
+    img.save(data, "JPEG", quality=90)
+    return data.getvalue()
+
+
+def full_decode(data: bytes, path: Path):
+    from PIL import Image
+    img = Image.open(BytesIO(data))
+    img.resize((64, 64)).save(path)
+
+
+def report(label: str, images: int, seconds: float):
+    print(f"{label:>28}: {images / seconds:8.1f} images/s  ({seconds * 1000:8.1f}ms for {images})")
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Benchmark thumbnail decoding")
+    parser.add_argument("images", nargs="?", type=int, default=200)
+    parser.add_argument("--sizes", nargs="+", type=int, default=[64, 128])
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    covers = [make_cover(i) for i in range(args.images)]
+    print(f"{args.images} covers of 640px, {sum(map(len, covers)) / len(covers) / 1024:.0f}KiB on average")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+
+        def paths(i: int, sizes: list):
+            return {size: tmp / f"{i}_{size}.jpg" for size in sizes}
+
+        start = perf_counter()
+        for i, data in enumerate(covers):
+            full_decode(data, tmp / f"{i}.jpg")
+        report("full decode, 64px", args.images, perf_counter() - start)
+
+        start = perf_counter()
+        for i, data in enumerate(covers):
+            save_thumbnails(data, paths(i, [64]))
+        report("draft decode, 64px", args.images, perf_counter() - start)
+
+        label = ", ".join(map(str, args.sizes))
+        start = perf_counter()
+        for i, data in enumerate(covers):
+            save_thumbnails(data, paths(i, args.sizes))
+        report(f"draft decode, {label}px", args.images, perf_counter() - start)
+
+        start = perf_counter()
+        context = multiprocessing.get_context("forkserver")
+        with ProcessPoolExecutor(max_workers=args.processes, mp_context=context) as pool:
+            list(pool.map(save_thumbnails, covers, [paths(i, args.sizes) for i in range(args.images)], chunksize=8))
+        report(f"{args.processes} processes, {label}px", args.images, perf_counter() - start)
@@ -1,7 +1,12 @@
 #!/bin/sh
+# ships precompiled bytecode so launches don't compile the sources from the zip
+# the .pyc files are tied to the python3 used here, which must match the one that runs build/play-menu
 fn='play-menu'
-zip "${fn}.zip" *.py
+tmp_dir=$(mktemp -d)
+cp *.py "$tmp_dir"
+python3 -m compileall -q -b --invalidation-mode unchecked-hash -s "$tmp_dir" "$tmp_dir" || exit 1
+(cd "$tmp_dir" && zip -q "${fn}.zip" *.pyc)
 [ -d "build" ] || mkdir "build"
-echo '#!/bin/env python3' | cat - "${fn}.zip" > "build/$fn"
-rm "$fn.zip"
-chmod +x "build/$fn"
\ No newline at end of file
+echo '#!/bin/env python3' | cat - "$tmp_dir/${fn}.zip" > "build/$fn"
+rm -r "$tmp_dir"
+chmod +x "build/$fn"
@@ -0,0 +1,177 @@
+# local catalogue of every track in the playlists of my_playlists.txt
+# a playlist is only paged through again when its snapshot_id changed, so syncing an unchanged catalogue costs
+# one small request per playlist, and lookups (e.g. which playlists contain a track) make no API calls at all
+import json
+import sqlite3
+import threading
+
+from util import catalogue_file
+
+# the track fields kept in the catalogue, requested per playlist item so pages stay small
+item_fields = "items(track(uri,name,artists(name),album(images))),total,limit"
+
+_db = None
+_lock = threading.Lock()
+
+
+def get_db():
+    global _db
+    if not _db:
+        _db = sqlite3.connect(catalogue_file, check_same_thread=False)
+        _db.execute("PRAGMA journal_mode=WAL")
+        _db.execute("CREATE TABLE IF NOT EXISTS playlists "
+                    "(uri TEXT PRIMARY KEY, name TEXT, position INTEGER, snapshot_id TEXT)")
+        # rank: the track's menu position, where it first appears going through the playlists in order
+        _db.execute("CREATE TABLE IF NOT EXISTS tracks "
+                    "(uri TEXT PRIMARY KEY, name TEXT, artists TEXT, img_url TEXT, thumb TEXT, rank INTEGER)")
+        _db.execute("CREATE INDEX IF NOT EXISTS tracks_rank ON tracks (rank)")
+        _db.execute("CREATE TABLE IF NOT EXISTS playlist_tracks "
+                    "(playlist TEXT, position INTEGER, track TEXT, PRIMARY KEY (playlist, position))")
+        # the reverse index, from a track to the playlists containing it
+        _db.execute("CREATE INDEX IF NOT EXISTS playlist_tracks_track ON playlist_tracks (track)")
+    return _db
+
+
+def _track_row(uri: str, name: str, artists: list, img_url: str, digests: dict):
+    import thumbnails
+    if img_url and img_url not in digests:
+        # tracks of the same album share a cover, hash it once
+        digests[img_url] = thumbnails.get_digest(img_url)
+    return uri, name, json.dumps(artists), img_url, digests.get(img_url)
+
+
+# ranks are only recomputed when a sync changed the playlists, so reading the menu needs no grouping
+def _rank_tracks(db):
+    ranks = {}
+    for rank, (uri,) in enumerate(db.execute("SELECT pt.track FROM playlist_tracks pt JOIN playlists p "
+                                             "ON p.uri = pt.playlist ORDER BY p.position, pt.position")):
+        ranks.setdefault(uri, rank)
+    db.executemany("UPDATE tracks SET rank = ? WHERE uri = ?", [(rank, uri) for uri, rank in ranks.items()])
+
+
+def _store_playlist(db, playlist_uri: str, snapshot_id: str, items: list):
+    from util import get_best_img_from_list
+
+    uris = []
+    tracks = {}
+    digests = {}
+    for item in items:
+        track = item['track']
+        # removed tracks come back as null and local files have no playable uri
+        if not track or not track.get('uri') or not track['uri'].startswith("spotify:track:"):
+            continue
+        uris.append(track['uri'])
+        if track['uri'] not in tracks:
+            best_img = get_best_img_from_list(track.get('album', {}).get('images'))
+            tracks[track['uri']] = _track_row(track['uri'], track['name'],
+                                              [artist['name'] for artist in track['artists']],
+                                              best_img['url'] if best_img else None, digests)
+
+    db.execute("DELETE FROM playlist_tracks WHERE playlist = ?", (playlist_uri,))
+    db.executemany("INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?, NULL)", tracks.values())
+    db.executemany("INSERT INTO playlist_tracks VALUES (?, ?, ?)",
+                   [(playlist_uri, position, uri) for position, uri in enumerate(uris)])
+    db.execute("UPDATE playlists SET snapshot_id = ? WHERE uri = ?", (snapshot_id, playlist_uri))
+
+
+def get_my_playlists():
+    from spotify_item import Favorites, Playlist
+    from util import my_playlists_file
+    return [item for item in Favorites.from_file(my_playlists_file) if isinstance(item, Playlist)]
+
+
+# brings the catalogue up to date with my_playlists.txt, returns the number of playlists that were fetched
+def sync(playlists: list = None):
+    from util import run_async
+    return run_async(_sync(get_my_playlists() if playlists is None else playlists))
+
+
+async def _sync(playlists: list):
+    import asyncio
+    import tracing
+    from util import get_async_spotify
+
+    client = get_async_spotify()
+    with tracing.span("catalogue sync", playlists=len(playlists)):
+        snapshots = await asyncio.gather(*(client.playlist(playlist.uri, fields="snapshot_id")
+                                           for playlist in playlists))
+        with _lock:
+            known = {uri: (snapshot_id, position) for uri, snapshot_id, position
+                     in get_db().execute("SELECT uri, snapshot_id, position FROM playlists").fetchall()}
+        changed = [(playlist, snapshot['snapshot_id']) for playlist, snapshot in zip(playlists, snapshots)
+                   if known.get(playlist.uri, (None,))[0] != snapshot['snapshot_id']]
+        pages = await asyncio.gather(*(client.get_all_items("playlist_items", playlist.uri, fields=item_fields,
+                                                            additional_types=("track",))
+                                       for playlist, _ in changed))
+
+    with _lock:
+        db = get_db()
+        uris = [playlist.uri for playlist in playlists]
+        db.execute(f"DELETE FROM playlists WHERE uri NOT IN ({','.join('?' * len(uris))})", uris)
+        db.execute("DELETE FROM playlist_tracks WHERE playlist NOT IN (SELECT uri FROM playlists)")
+        for position, playlist in enumerate(playlists):
+            db.execute("INSERT INTO playlists VALUES (?, ?, ?, NULL) "
+                       "ON CONFLICT(uri) DO UPDATE SET name = excluded.name, position = excluded.position",
+                       (playlist.uri, playlist.name, position))
+        for (playlist, snapshot_id), items in zip(changed, pages):
+            _store_playlist(db, playlist.uri, snapshot_id, items)
+        if changed or {uri: position for uri, (_, position) in known.items()} != \
+                {uri: position for position, uri in enumerate(uris)}:
+            db.execute("DELETE FROM tracks WHERE uri NOT IN (SELECT track FROM playlist_tracks)")
+            _rank_tracks(db)
+        db.commit()
+
+    if changed:
+        print(f"Synced {len(changed)}/{len(playlists)} playlists")
+    return len(changed)
+
+
+# records a track we added ourselves, moving the playlist to the snapshot returned by the add call
+# checked_snapshot_id: the snapshot the playlist was checked against before adding, if the catalogue is at another
+# one it is behind on changes made elsewhere and is left for the next sync to page through
+# playlists that aren't catalogued yet are left for the next sync too
+def add_track(playlist_uri: str, checked_snapshot_id: str, snapshot_id: str, track):
+    with _lock:
+        db = get_db()
+        if not db.execute("SELECT 1 FROM playlists WHERE uri = ? AND snapshot_id = ?",
+                          (playlist_uri, checked_snapshot_id)).fetchone():
+            return
+        position = db.execute("SELECT COALESCE(MAX(position) + 1, 0) FROM playlist_tracks WHERE playlist = ?",
+                              (playlist_uri,)).fetchone()[0]
+        # listed last until the next sync ranks it
+        db.execute("INSERT OR IGNORE INTO tracks VALUES "
+                   "(?, ?, ?, ?, ?, (SELECT COALESCE(MAX(rank) + 1, 0) FROM tracks))",
+                   _track_row(track.uri, track.name, track.artists, track.get_img_url(), {}))
+        db.execute("INSERT INTO playlist_tracks VALUES (?, ?, ?)", (playlist_uri, position, track.uri))
+        db.execute("UPDATE playlists SET snapshot_id = ? WHERE uri = ?", (snapshot_id, playlist_uri))
+        db.commit()
+
+
+def is_empty():
+    with _lock:
+        return not get_db().execute("SELECT 1 FROM playlists WHERE snapshot_id IS NOT NULL").fetchone()
+
+
+# every catalogued track once, in my_playlists.txt order and then playlist order, with its thumbnail digest
+def get_tracks():
+    from spotify_item import Track
+
+    with _lock:
+        rows = get_db().execute("SELECT uri, name, artists, img_url, thumb FROM tracks ORDER BY rank").fetchall()
+    return [(Track(name=name, artists=json.loads(artists), uri=uri, img_url=img_url), thumb)
+            for uri, name, artists, img_url, thumb in rows]
+
+
+# {playlist uri: snapshot_id}, which changes whenever the catalogued tracks do
+def get_snapshots():
+    with _lock:
+        return dict(get_db().execute("SELECT uri, snapshot_id FROM playlists").fetchall())
+
+
+# names of the catalogued playlists containing uri, in my_playlists.txt order
+def get_playlists_containing(uri: str):
+    with _lock:
+        rows = get_db().execute("SELECT DISTINCT p.name, p.position FROM playlist_tracks pt "
+                                "JOIN playlists p ON p.uri = pt.playlist WHERE pt.track = ? ORDER BY p.position",
+                                (uri,)).fetchall()
+    return [name for name, _ in rows]
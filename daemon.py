@@ -0,0 +1,186 @@
+import json
+import socket
+
+from util import daemon_socket
+
+# actions a running daemon can serve on behalf of a thin client
+client_actions = ("p", "s", "sp", "t", "a", "cache", "--cache-only", "--trace")
+
+
+def _request(request: dict, timeout: float = None):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(str(daemon_socket))
+        sock.sendall(json.dumps(request).encode() + b"\n")
+        with sock.makefile("rb") as f:
+            return json.loads(f.readline())
+
+
+# sends argv to the daemon and prints its output
+# returns the exit status, or None if no daemon is running so the caller can run the action itself
+def forward(argv: list):
+    if not daemon_socket.exists():
+        return None
+    try:
+        response = _request({'argv': argv})
+    except (ConnectionError, FileNotFoundError):
+        return None
+    if response['output']:
+        print(response['output'], end="")
+    return response['status']
+
+
+# round trip without running an action, used to measure client overhead
+def ping():
+    return _request({'argv': None}, timeout=5)['status']
+
+
+def stop():
+    try:
+        _request({'stop': True}, timeout=5)
+        print("Stopped daemon")
+    except (ConnectionError, FileNotFoundError):
+        print("No daemon running")
+
+
+# imports the heavy modules and opens the Spotify and D-Bus connections ahead of the first request
+def warm_up():
+    from time import perf_counter
+    start = perf_counter()
+
+    import dbus
+    import spotipy
+    from PIL import Image
+    from rofi import Rofi
+    import menus
+    import spotify_item
+    from util import get_spotify, get_session_bus, schedule_token_refresh, warm_api
+
+    get_session_bus()
+    # keeps the token fresh ahead of expiry for as long as the daemon runs
+    schedule_token_refresh(get_spotify().auth_manager, repeat=True)
+    warm_api()
+
+    print(f"Warmed up in {perf_counter() - start:.3f}s")
+
+
+# replaces sys.stdout and sys.stderr in the daemon: what the thread serving a request prints goes to that request's
+# output, what any other thread prints (the watcher, background fetches a request left running) to the daemon's own
+class _RequestOutput:
+
+    def __init__(self, stream, local):
+        self._stream = stream
+        self._local = local
+
+    def _target(self):
+        return getattr(self._local, 'output', None) or self._stream
+
+    def write(self, s):
+        return self._target().write(s)
+
+    def flush(self):
+        self._target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+def _capture_output():
+    import sys
+    import threading
+
+    local = threading.local()
+    sys.stdout = _RequestOutput(sys.stdout, local)
+    sys.stderr = _RequestOutput(sys.stderr, local)
+    return local
+
+
+def _handle(conn: socket.socket, run, captured):
+    import io
+    import traceback
+    from time import perf_counter
+    from util import get_args
+
+    with conn, conn.makefile("rb") as f:
+        request = json.loads(f.readline())
+        if request.get('stop'):
+            conn.sendall(json.dumps({'status': 0, 'output': ""}).encode() + b"\n")
+            return False
+
+        argv = request['argv']
+        output = io.StringIO()
+        status = 0
+        start = perf_counter()
+        if argv is not None:
+            captured.output = output
+            try:
+                run(get_args(argv))
+            except SystemExit as e:
+                status = e.code if isinstance(e.code, int) else 1
+            except Exception:
+                traceback.print_exc(file=output)
+                status = 1
+            finally:
+                captured.output = None
+            print(f"Served {argv} in {perf_counter() - start:.3f}s")
+
+        conn.sendall(json.dumps({'status': status, 'output': output.getvalue()}).encode() + b"\n")
+    return True
+
+
+# menus read the current track and context from the watcher's state instead of asking for them
+def _start_watcher():
+    import threading
+    from mpris_watcher import watch
+
+    def run():
+        try:
+            watch()
+        except Exception as e:
+            print(f"MPRIS watcher stopped: {e}")
+
+    threading.Thread(target=run, name="mpris-watcher", daemon=True).start()
+
+
+# serves requests one at a time so two menus never compete for the screen
+def serve(run):
+    import signal
+    import mpris_watcher
+    from util import player_state_file
+
+    try:
+        _request({'argv': None}, timeout=1)
+        print(f"Daemon already running on {daemon_socket}")
+        return
+    except (ConnectionError, FileNotFoundError, socket.timeout):
+        if daemon_socket.exists():
+            daemon_socket.unlink()
+
+    warm_up()
+    import tracing
+    tracing.in_daemon = True
+    _start_watcher()
+    # SIGTERM stops the daemon like Ctrl-C, cleaning up as --stop does (a SystemExit would be taken for an action's)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    captured = _capture_output()
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+        server.bind(str(daemon_socket))
+        server.listen()
+        print(f"Listening on {daemon_socket}")
+        try:
+            while True:
+                conn, _ = server.accept()
+                try:
+                    if not _handle(conn, run, captured):
+                        break
+                except (OSError, ValueError) as e:
+                    print(f"Dropped request: {e}")
+        except KeyboardInterrupt:
+            pass
+        finally:
+            daemon_socket.unlink()
+            # the watcher thread ends with the process without cleaning up after itself
+            # (unless another process's watcher held the lock, whose state this is)
+            if mpris_watcher.holding_lock:
+                player_state_file.unlink(missing_ok=True)
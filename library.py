@@ -0,0 +1,82 @@
+# local mirror of the user's saved tracks, so save status checks don't need an API call
+# {"uris": [...], "newest": uri of the most recently saved track, "total": int, "synced": unix time}
+from time import time
+
+from util import saved_tracks_file, saved_tracks_reconcile_interval, read_json, write_json
+
+_mirror = None
+
+
+def _fetch_newest():
+    from util import get_spotify
+    data = get_spotify().current_user_saved_tracks(limit=1)
+    newest = data['items'][0]['track']['uri'] if data['items'] else None
+    return newest, data['total']
+
+
+# pages through the whole library, 50 tracks per request, fetching pages concurrently
+def rebuild():
+    global _mirror
+    from util import get_async_spotify, run_async
+
+    print("Building saved tracks mirror")
+    data = run_async(get_async_spotify().get_all_items("current_user_saved_tracks", limit=50))
+    uris = [item['track']['uri'] for item in data if item['track']]
+
+    _mirror = {'uris': uris, 'newest': uris[0] if uris else None, 'total': len(data), 'synced': time()}
+    write_json(saved_tracks_file, _mirror)
+    return _mirror
+
+
+# a single request confirms the mirror is current if the library size and newest track still match
+def reconcile():
+    newest, total = _fetch_newest()
+    if _mirror['newest'] == newest and _mirror['total'] == total:
+        _mirror['synced'] = time()
+        write_json(saved_tracks_file, _mirror)
+        return _mirror
+    return rebuild()
+
+
+# the mirror as last synced, or None before the first sync, read without any API call
+def get_mirror():
+    global _mirror
+    if _mirror is None:
+        _mirror = read_json(saved_tracks_file)
+    return _mirror
+
+
+# builds the mirror on first use and reconciles it once it is older than the interval
+# the save menu runs this while rofi is open, so no request stands between launching it and the menu
+def refresh():
+    mirror = get_mirror()
+    if not mirror:
+        return rebuild()
+    if time() - mirror['synced'] > saved_tracks_reconcile_interval:
+        return reconcile()
+    return mirror
+
+
+# as of the last sync, False before the first one
+def is_saved(uri: str):
+    mirror = get_mirror()
+    return bool(mirror) and uri in mirror['uris']
+
+
+# records a save or removal we made ourselves, keeping the mirror current without refetching
+def set_saved(uri: str, saved: bool):
+    mirror = get_mirror()
+    # the first sync will include it
+    if not mirror:
+        return
+    uris = mirror['uris']
+    if saved and uri not in uris:
+        uris.insert(0, uri)
+        mirror['newest'] = uri
+        mirror['total'] += 1
+    elif not saved and uri in uris:
+        uris.remove(uri)
+        mirror['total'] -= 1
+        if mirror['newest'] == uri:
+            mirror['newest'] = uris[0] if uris else None
+    write_json(saved_tracks_file, mirror)
@@ -1,11 +1,13 @@
 from pathlib import Path
-from rofi import Rofi
 
 from util import get_current_track, add_icon_to_str, favorites_file
 from spotify_item import Favorites, Track
+from prefetch import Prefetcher
+import tracing
 
 
 def prompt_menu(question: str, no_first=True, str_yes="Yes", str_no="No"):
+    from rofi import Rofi
     r = Rofi(rofi_args=["-i"])
 
     str_yes = add_icon_to_str(str_yes, "object-select")
@@ -17,17 +19,45 @@ def prompt_menu(question: str, no_first=True, str_yes="Yes", str_no="No"):
     return options[index] == str_yes
 
 
+# rofi.select with -multi-select, where Shift+Return marks rows, returns (indices, key)
+# indices are the marked rows, or the row under the cursor if none were marked, and empty when cancelled
+# python-rofi parses a single index, so the indices are taken from rofi's output before it does
+def select_many(rofi, prompt: str, options: list, **kwargs):
+    selected = []
+    run_blocking = rofi._run_blocking
+
+    def run(args, input=None):
+        returncode, stdout = run_blocking([*args, "-multi-select"], input)
+        selected.extend(int(line) for line in stdout.split())
+        return returncode, ""
+
+    rofi._run_blocking = run
+    try:
+        _, key = rofi.select(prompt, options, **kwargs)
+    finally:
+        del rofi._run_blocking
+    return selected, key
+
+
 def play_menu(path: Path = favorites_file):
-    favs = Favorites.from_file(path)
+    from rofi import Rofi
+
+    from util import warm_api
 
-    favs.save_all_images()
+    favs, display_list = Favorites.load_for_menu(path, detail=2)
+    favs.fetch_images(display_list)
 
     rofi = Rofi(rofi_args=["-no-sort", "-i", "-matching", "fuzzy"])
-    index, key = rofi.select("Play", favs.get_display_list(detail=2),
-                             key1=("Alt+Shift+Return", "Play without shuffle\n"),
-                             key2=("Alt+Return", "Play with shuffle\n"),
-                             key8=("Alt+p", "Search Spotify\n"),
-                             key9=("Alt+X", "Remove from menu"))
+    with Prefetcher() as prefetch:
+        # set_shuffle is the only Web API call that can follow
+        prefetch.submit_request("api", warm_api)
+        tracing.mark("rofi-display")
+        with tracing.span("rofi", "ui"):
+            index, key = rofi.select("Play", display_list,
+                                     key1=("Alt+Shift+Return", "Play without shuffle\n"),
+                                     key2=("Alt+Return", "Play with shuffle\n"),
+                                     key8=("Alt+p", "Search Spotify\n"),
+                                     key9=("Alt+X", "Remove from menu"))
 
     # escape key/exit was pressed
     if index == -1:
@@ -45,7 +75,8 @@ def play_menu(path: Path = favorites_file):
         remove = prompt_menu(f"Remove {repr(item)} from favorites?", no_first=True)
         if remove:
             favs.remove_item(item)
-            favs.write()
+            favs.write(path)
+            favs.write_snapshot(path, detail=2)
         return
 
     # play without shuffle
@@ -57,16 +88,17 @@ def play_menu(path: Path = favorites_file):
         from util import set_shuffle
         set_shuffle(True)
 
-    favs.bring_to_top(item)
-    favs.write(path)
+    # one line appended to the usage log, the next launch reorders its snapshot from it
+    favs.record_play(item)
 
     item.play()
 
 
 def save_menu():
     from collections import OrderedDict
-    from spotify_item import SpotifyItem
-    from util import my_playlists_file, notify_context
+    from rofi import Rofi
+    import library
+    from util import my_playlists_file, notify_context, warm_api
 
     rofi = Rofi(rofi_args=["-no-sort", "-i"])
 
@@ -74,55 +106,176 @@ def save_menu():
 
     options = OrderedDict()
 
-    options[add_icon_to_str("Save Song", "emblem-favorite")] = track.save
+    options[add_icon_to_str("Song saved" if track.is_saved() else "Save Song", "emblem-favorite")] = lambda: set_saved(
+        track, True, prefetch)
     options[add_icon_to_str("Add song to playlist", "list-add")] = lambda: add_to_playlist_menu(my_playlists_file,
                                                                                                 track)
-    options[add_icon_to_str("Play track album", "media-playback-start")] = lambda: SpotifyItem.from_uri(
-        track.uri).album.play()
-    options[add_icon_to_str("Query context", "dialog-question")] = lambda: notify_context()
-    options[add_icon_to_str("Remove song", "user-trash")] = track.unsave
-    index, key = rofi.select("Music", list(options.keys()), message=rofi.escape(str(track)))
+    options[add_icon_to_str("Play track album", "media-playback-start")] = lambda: prefetch.get(
+        "album", get_track_album, track).play()
+    options[add_icon_to_str("Query context", "dialog-question")] = lambda: notify_context(
+        prefetch.get("playback", get_playback_with_context_img))
+    options[add_icon_to_str("Remove song", "user-trash")] = lambda: set_saved(track, False, prefetch)
+
+    with Prefetcher() as prefetch:
+        prefetch.submit_request("api", warm_api)
+        # the label above came from the mirror as it was, it is brought up to date for the next launch
+        prefetch.submit_request("library", library.refresh)
+        prefetch.submit_request("album", get_track_album, track)
+        prefetch.submit_request("playback", get_playback_with_context_img)
+
+        tracing.mark("rofi-display")
+        with tracing.span("rofi", "ui"):
+            index, key = rofi.select("Music", list(options.keys()),
+                                     message=rofi.escape("\n".join(filter(None, (str(track), in_playlists(track))))))
+
+        # user escape/quit
+        if index == -1:
+            return
+
+        # call the lambda at the chosen index
+        list(options.values())[index]()
+
+
+# saves or removes track once the library refresh started with the menu is done, so it can't undo the change
+def set_saved(track: Track, saved: bool, prefetch: Prefetcher):
+    import library
+    prefetch.get("library", library.refresh)
+    if saved:
+        track.save()
+    else:
+        track.unsave()
+
+
+# which of my playlists already contain track, answered from the local catalogue without API calls
+def in_playlists(track: Track):
+    import catalogue
+    names = catalogue.get_playlists_containing(track.uri)
+    return f"In {', '.join(names)}" if names else ""
+
+
+def get_track_album(track: Track):
+    from spotify_item import SpotifyItem
+    return SpotifyItem.from_uri(track.uri).album
 
-    # user escape/quit
-    if index == -1:
-        return
 
-    # call the lambda at the chosen index
-    list(options.values())[index]()
+# the current playback, with the context image saved for the notification
+def get_playback_with_context_img():
+    from util import get_current_playback
+
+    playback = get_current_playback()
+    _, context = playback
+    if context and not context.is_img_saved():
+        context.save_img()
+    return playback
 
 
 def add_to_playlist_menu(playlist_path: Path, track: Track):
+    from rofi import Rofi
     from spotify_item import Playlist
+    from util import warm_api
 
-    pls = Favorites.from_file(playlist_path)
-
-    pls.save_all_images()
+    pls, display_list = Favorites.load_for_menu(playlist_path, detail=0)
+    pls.fetch_images(display_list)
 
     rofi = Rofi(rofi_args=["-no-sort", "-i"])
-    index, key = rofi.select(f"Add \"{track}\" to playlist", pls.get_display_list(detail=0),
-                             key9=("Alt-X", "Remove Playlist"))
+    with Prefetcher() as prefetch:
+        prefetch.submit_request("api", warm_api)
+        # the membership checks for whichever playlists get picked
+        for playlist in pls:
+            if isinstance(playlist, Playlist):
+                prefetch.submit_request(playlist.uri, playlist.check_uri, track.uri)
+
+        tracing.mark("rofi-display")
+        with tracing.span("rofi", "ui"):
+            indices, key = select_many(rofi, f"Add \"{track}\" to playlist", display_list,
+                                       message=rofi.escape(in_playlists(track)),
+                                       key9=("Alt-X", "Remove Playlist"))
+
+        # escape key/exit was pressed
+        if not indices:
+            return
+
+        selected = [pls.items[index] for index in indices]
+
+        # remove playlists
+        if key == 9:
+            remove = prompt_menu(f"Remove {', '.join(map(str, selected))} from playlists?", no_first=True)
+            if remove:
+                for playlist in selected:
+                    pls.remove_item(playlist)
+                pls.write(playlist_path)
+                pls.write_snapshot(playlist_path, detail=0)
+            return
+
+        selected = [playlist for playlist in selected if isinstance(playlist, Playlist)]
+        if selected and prompt_menu(f"Add {track} to {', '.join(playlist.name for playlist in selected)}?",
+                                    no_first=False):
+            add_to_playlists(track, selected, prefetch)
+
+
+# adds track to every playlist at once, each using its prefetched membership check, with one notification for all
+def add_to_playlists(track: Track, playlists: list, prefetch: Prefetcher):
+    from concurrent.futures import ThreadPoolExecutor
+    from util import notify_send
+
+    def add(playlist):
+        return playlist.add_item(track, checked=prefetch.get(playlist.uri, playlist.check_uri, track.uri), notify=False)
+
+    with ThreadPoolExecutor(max_workers=len(playlists)) as executor:
+        added = list(executor.map(add, playlists))
+
+    lines = []
+    added_to = [playlist.name for playlist, was_added in zip(playlists, added) if was_added]
+    present_in = [playlist.name for playlist, was_added in zip(playlists, added) if not was_added]
+    if added_to:
+        lines.append(f"Added track to {', '.join(added_to)}")
+    if present_in:
+        lines.append(f"Already in {', '.join(present_in)}")
+    image = playlists[0].get_img_path() if len(playlists) == 1 else track.get_img_path()
+    notify_send("\n".join((*lines, str(track))), image=image)
+
+
+# every track in my playlists, from the local catalogue, which is synced while the menu is open
+def track_menu():
+    import catalogue
+    import thumbnails
+    from rofi import Rofi
+    from util import thumbs_dir, img_ext
+
+    # the first run has nothing to show until the catalogue is built
+    if catalogue.is_empty():
+        catalogue.sync()
+
+    with tracing.span("load catalogue"):
+        tracks = catalogue.get_tracks()
+        saved = thumbnails.get_saved_digests()
+        display_list = [add_icon_to_str(str(track), thumbs_dir / f"{thumb}.{img_ext}") if thumb in saved
+                        else str(track) for track, thumb in tracks]
+
+    rofi = Rofi(rofi_args=["-i", "-matching", "fuzzy"])
+    with Prefetcher() as prefetch:
+        # playlist changes show up the next time the menu is opened
+        prefetch.submit_request("sync", catalogue.sync)
+        tracing.mark("rofi-display")
+        with tracing.span("rofi", "ui"):
+            index, key = rofi.select("Play track", display_list)
 
-    # escape key/exit was pressed
     if index == -1:
         return
-
-    playlist = pls.items[index]
-
-    # remove playlist
-    if key == 9:
-        remove = prompt_menu(f"Remove {playlist} from playlists?", no_first=True)
-        if remove:
-            pls.remove_item(playlist)
-            pls.write(playlist_path)
-        return
-
-    if isinstance(playlist, Playlist):
-        if prompt_menu(f"Add {track} to {playlist.name}?", no_first=False):
-            playlist.add_item(track)
+    tracks[index][0].play()
 
 
 def search_menu():
+    from rofi import Rofi
+    import search_index
     from spotify_search import play_search
     r = Rofi()
 
-    play_search(r.text_entry("Play Song"))
+    with Prefetcher() as prefetch:
+        # index whatever was fetched or added since the last search while the query is typed
+        prefetch.submit("index", search_index.sync)
+        query = r.text_entry("Play Song")
+        if not query:
+            return
+        prefetch.get("index", search_index.sync)
+    play_search(query)
@@ -0,0 +1,129 @@
+# on-disk cache of Web API item metadata shared across invocations
+# entries expire per item type and the least recently used ones are evicted past max_entries
+import json
+import sqlite3
+import threading
+from time import time
+
+from util import metadata_cache_file, get_uri_type, flush_accessed
+
+# seconds before cached metadata of each item type is fetched again
+ttls = {
+    "playlist": 24 * 60 * 60,
+    "album": 30 * 24 * 60 * 60,
+    "artist": 7 * 24 * 60 * 60,
+    "track": 30 * 24 * 60 * 60,
+}
+max_entries = 10000
+
+# serve only from the cache, expired entries included, raising CacheMiss instead of calling the API
+cache_only = False
+
+
+class CacheMiss(LookupError):
+    pass
+
+
+_db = None
+_lock = threading.Lock()
+# access times of cache hits, written on flush so reads never hold the database's write lock
+_accessed = {}
+_hits = 0
+_misses = 0
+
+
+def get_db():
+    global _db
+    if not _db:
+        _db = sqlite3.connect(metadata_cache_file, check_same_thread=False)
+        _db.execute("PRAGMA journal_mode=WAL")
+        _db.execute("PRAGMA synchronous=NORMAL")
+        _db.execute("CREATE TABLE IF NOT EXISTS metadata "
+                    "(uri TEXT PRIMARY KEY, data TEXT, fetched REAL, accessed REAL)")
+        _db.execute("CREATE INDEX IF NOT EXISTS metadata_accessed ON metadata (accessed)")
+        _db.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)")
+    return _db
+
+
+def _lookup(uri: str):
+    global _hits
+    with _lock:
+        db = get_db()
+        row = db.execute("SELECT data, fetched FROM metadata WHERE uri = ?", (uri,)).fetchone()
+        if row and (cache_only or time() - row[1] < ttls[get_uri_type(uri)]):
+            _accessed[uri] = time()
+            _hits += 1
+            return json.loads(row[0])
+    return None
+
+
+def _miss(uri: str):
+    global _misses
+    with _lock:
+        _misses += 1
+    if cache_only:
+        raise CacheMiss(f"{uri} is not cached")
+
+
+def put(uri: str, data: dict):
+    now = time()
+    with _lock:
+        db = get_db()
+        db.execute("INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?)", (uri, json.dumps(data), now, now))
+        # committed right away, an open menu must not keep other invocations from writing
+        db.commit()
+
+
+# returns the metadata for uri, calling fetch(uri) on a miss
+def get(uri: str, fetch):
+    data = _lookup(uri)
+    if data is None:
+        _miss(uri)
+        data = fetch(uri)
+        if data:
+            put(uri, data)
+    return data
+
+
+# like get, but fetches all missing uris with a single fetch(uris) call returning a list in the same order
+def get_many(uris: list, fetch):
+    results = {uri: _lookup(uri) for uri in uris}
+    missing = [uri for uri, data in results.items() if data is None]
+    for uri in missing:
+        _miss(uri)
+    if missing:
+        for uri, data in zip(missing, fetch(missing)):
+            results[uri] = data
+            if data:
+                put(uri, data)
+    return [results[uri] for uri in uris]
+
+
+# (uri, data, fetched) of every entry fetched after since, for indexing new metadata
+def get_fetched_since(since: float):
+    with _lock:
+        rows = get_db().execute("SELECT uri, data, fetched FROM metadata WHERE fetched > ?", (since,)).fetchall()
+    return [(uri, json.loads(data), fetched) for uri, data, fetched in rows]
+
+
+# persists access times and the hit/miss counters and evicts the least recently used entries
+def flush():
+    global _hits, _misses
+    if not _db:
+        return
+    with _lock:
+        evict = ("DELETE FROM metadata WHERE uri NOT IN (SELECT uri FROM metadata ORDER BY accessed DESC LIMIT ?)",
+                 (max_entries,))
+        if flush_accessed(_db, "metadata", "uri", _accessed, _hits, _misses, "metadata cache", evict):
+            _hits = _misses = 0
+
+
+def get_stats():
+    flush()
+    with _lock:
+        db = get_db()
+        stats = dict(db.execute("SELECT name, value FROM stats").fetchall())
+        stats['entries'] = db.execute("SELECT COUNT(*) FROM metadata").fetchone()[0]
+    stats.setdefault('hits', 0)
+    stats.setdefault('misses', 0)
+    return stats
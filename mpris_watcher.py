@@ -0,0 +1,183 @@
+# keeps the Spotify client's current track, playback status and context in player.json
+# the state is updated from MPRIS PropertiesChanged signals as they arrive, so menus read it from a small file
+# instead of making a D-Bus round trip for the track and a Web API call for the context on every invocation
+# MPRIS has no notion of context, so it is fetched from the Web API once per track change, off the menu's path
+import fcntl
+import threading
+from time import time, sleep
+
+from util import player_state_file, player_lock_file, read_json, write_json
+
+bus_name = "org.mpris.MediaPlayer2.spotify"
+object_path = "/org/mpris/MediaPlayer2"
+player_interface = "org.mpris.MediaPlayer2.Player"
+
+# the Web API can lag behind MPRIS on a track change, the context is asked for again until it agrees
+context_attempts = 3
+context_retry_delay = 1
+# is_running holds the lock for an instant, a watcher starting at that moment tries again before giving up
+lock_attempts = 5
+lock_retry_delay = 0.02
+
+# set once this process's watcher holds the lock, so only it removes the state file when the process ends
+holding_lock = False
+
+
+# whether a watcher holds the lock file, which the system releases however the watcher's process ends
+def is_running():
+    try:
+        with player_lock_file.open("rb") as f:
+            fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return True
+    except OSError:
+        # no lock file, no watcher ever ran
+        pass
+    return False
+
+
+# the state written by a running watcher, or None if no watcher is running
+def read_state():
+    if not is_running():
+        return None
+    return read_json(player_state_file)
+
+
+# the current track's metadata from a running watcher, as plain str and list values
+def get_metadata():
+    state = read_state()
+    return state['metadata'] if state else None
+
+
+# the current context uri, False if no watcher knows it (yet), None if the track is playing without one
+def get_context_uri(track_uri: str):
+    state = read_state()
+    if not state or not state['metadata'] or state['context_track'] != track_uri:
+        return False
+    return state['context']
+
+
+# the MPRIS metadata with D-Bus types turned into json values
+def to_plain(metadata):
+    import dbus
+    return {str(key): [str(v) for v in value] if isinstance(value, dbus.Array) else str(value)
+            for key, value in metadata.items()}
+
+
+class Watcher:
+
+    # fetch_context: look the context up on the Web API after every track change
+    def __init__(self, bus, fetch_context=True):
+        self.bus = bus
+        self.fetch_context = fetch_context
+        self.state = {'metadata': None, 'status': None, 'context': None, 'context_track': None, 'updated': None}
+        self._lock = threading.Lock()
+
+    def start(self):
+        import dbus
+        self.bus.add_signal_receiver(self._on_properties_changed, signal_name="PropertiesChanged",
+                                     dbus_interface=dbus.PROPERTIES_IFACE, bus_name=bus_name, path=object_path)
+        # Spotify starting or quitting
+        self.bus.add_signal_receiver(self._on_owner_changed, signal_name="NameOwnerChanged",
+                                     dbus_interface="org.freedesktop.DBus", arg0=bus_name)
+        self._load()
+
+    def _load(self):
+        import dbus
+        try:
+            properties = self.bus.get_object(bus_name, object_path).GetAll(
+                player_interface, dbus_interface=dbus.PROPERTIES_IFACE)
+        except dbus.DBusException:
+            # not running yet
+            properties = None
+        self._update(properties, reset=True)
+
+    def _on_owner_changed(self, name, old_owner, new_owner):
+        if new_owner:
+            self._load()
+        else:
+            self._update(None, reset=True)
+
+    def _on_properties_changed(self, interface, changed, invalidated):
+        if interface == player_interface:
+            self._update(changed)
+
+    def _update(self, properties, reset=False):
+        fetch = None
+        with self._lock:
+            if reset:
+                self.state.update(metadata=None, status=None, context=None, context_track=None)
+            if properties and "Metadata" in properties:
+                metadata = to_plain(properties["Metadata"])
+                track_uri = metadata.get('mpris:trackid')
+                if not self.state['metadata'] or self.state['metadata'].get('mpris:trackid') != track_uri:
+                    self.state.update(context=None, context_track=None)
+                    fetch = track_uri
+                self.state['metadata'] = metadata
+            if properties and "PlaybackStatus" in properties:
+                self.state['status'] = str(properties["PlaybackStatus"])
+            self._write()
+
+        if fetch and self.fetch_context:
+            threading.Thread(target=self._update_context, args=(fetch,), name="mpris-context", daemon=True).start()
+
+    def _write(self):
+        self.state['updated'] = time()
+        write_json(player_state_file, self.state)
+
+    def _update_context(self, track_uri: str):
+        from util import get_spotify
+
+        for attempt in range(context_attempts):
+            if attempt:
+                sleep(context_retry_delay)
+            try:
+                data = get_spotify().current_playback()
+            except Exception as e:
+                print(f"Fetching context failed: {e}")
+                return
+            if data and data['item'] and data['item']['uri'] == track_uri:
+                with self._lock:
+                    # the track changed again while fetching
+                    if self.state['metadata'] and self.state['metadata'].get('mpris:trackid') == track_uri:
+                        self.state.update(context=data['context']['uri'] if data['context'] else None,
+                                          context_track=track_uri)
+                        self._write()
+                return
+
+
+# runs a watcher until interrupted, on the session bus or the bus at address
+def watch(address: str = None, fetch_context=True):
+    global holding_lock
+    import dbus
+    from dbus.mainloop.glib import DBusGMainLoop, threads_init
+    from gi.repository import GLib
+
+    lock = player_lock_file.open("wb")
+    for attempt in range(lock_attempts):
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            break
+        except BlockingIOError:
+            if attempt == lock_attempts - 1:
+                lock.close()
+                print("Another watcher is running")
+                return
+            sleep(lock_retry_delay)
+    holding_lock = True
+
+    # the daemon runs the watcher next to its other threads
+    threads_init()
+    mainloop = DBusGMainLoop()
+    # a connection of its own, so signal handling never depends on who else uses the shared one
+    bus = dbus.bus.BusConnection(address, mainloop=mainloop) if address \
+        else dbus.SessionBus(mainloop=mainloop, private=True)
+    Watcher(bus, fetch_context).start()
+    print("Watching Spotify over MPRIS")
+    try:
+        GLib.MainLoop().run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        player_state_file.unlink(missing_ok=True)
+        lock.close()
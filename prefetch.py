@@ -0,0 +1,61 @@
+# speculative work started while a rofi menu is open, so the chosen action finds its data ready
+# tasks run on daemon threads: results nobody asks for are cancelled or abandoned instead of delaying exit
+# (a traced invocation waits for them, so the requests they make are counted)
+import threading
+from concurrent.futures import Future
+
+import tracing
+
+
+class Prefetcher:
+
+    def __init__(self, max_workers: int = 4):
+        self._semaphore = threading.Semaphore(max_workers)
+        self._futures = {}
+
+    def submit(self, key, fn, *args):
+        future = Future()
+
+        def run():
+            with self._semaphore:
+                if not future.set_running_or_notify_cancel():
+                    return
+                try:
+                    future.set_result(fn(*args))
+                except BaseException as e:
+                    future.set_exception(e)
+
+        self._futures[key] = future
+        tracing.start_thread(run, name=f"prefetch-{key}")
+        return future
+
+    # like submit, for work that only saves the chosen action a request, e.g. warming the connection or syncing,
+    # skipped under --cache-only so an open menu makes no requests of its own (get then runs fn if it's needed)
+    def submit_request(self, key, fn, *args):
+        import metadata_cache
+        if metadata_cache.cache_only:
+            return None
+        return self.submit(key, fn, *args)
+
+    # the prefetched result for key, or fn(*args) if it wasn't prefetched or the prefetch failed
+    def get(self, key, fn, *args):
+        future = self._futures.pop(key, None)
+        if future and not future.cancelled():
+            try:
+                return future.result()
+            except Exception as e:
+                print(f"Prefetch of {key} failed, retrying: {e}")
+        return fn(*args)
+
+    # cancels every prefetch that wasn't used and hasn't started, running ones are left to finish
+    def cancel(self):
+        cancelled = sum(future.cancel() for future in self._futures.values())
+        if cancelled:
+            print(f"Cancelled {cancelled} unused prefetches")
+        self._futures.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.cancel()
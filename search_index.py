@@ -0,0 +1,187 @@
+# local trigram index over every item PlayMenu has seen: favorites, my_playlists, cached metadata, the playlist
+# catalogue and tracks seen playing through MPRIS, so searches for known items need no network round trip
+# items are matched by the share of the query's trigrams they contain, which tolerates typos and word order
+import json
+import re
+import sqlite3
+import threading
+import unicodedata
+
+from util import search_index_file
+
+# ranking bonus by where an item was seen, an item keeps the highest of its sources
+boosts = {
+    "favorites": 0.2,
+    "my_playlists": 0.1,
+    "mpris": 0.1,
+    "catalogue": 0.05,
+    "metadata": 0,
+}
+# share of the query's trigrams a result must contain to be used instead of a remote search
+min_coverage = 0.75
+# and share of the result's name the query must cover, so "love" isn't taken for "Love Story"
+min_name_coverage = 0.75
+max_candidates = 100
+
+_db = None
+_lock = threading.Lock()
+# tracks seen through MPRIS, written on flush
+_seen = []
+
+
+def get_db():
+    global _db
+    if not _db:
+        _db = sqlite3.connect(search_index_file, check_same_thread=False)
+        _db.execute("PRAGMA journal_mode=WAL")
+        _db.execute("PRAGMA synchronous=NORMAL")
+        _db.execute("CREATE TABLE IF NOT EXISTS items (id INTEGER PRIMARY KEY, uri TEXT UNIQUE, type TEXT, "
+                    "name TEXT, artists TEXT, grams INTEGER, boost REAL)")
+        _db.execute("CREATE TABLE IF NOT EXISTS grams (gram TEXT, item INTEGER, PRIMARY KEY (gram, item)) "
+                    "WITHOUT ROWID")
+        # how far each source has been indexed
+        _db.execute("CREATE TABLE IF NOT EXISTS sources (name TEXT PRIMARY KEY, state TEXT)")
+    return _db
+
+
+def normalize(string: str):
+    string = unicodedata.normalize("NFKD", string.lower())
+    string = "".join(c for c in string if not unicodedata.combining(c))
+    return " ".join(re.sub(r"[\W_]+", " ", string).split())
+
+
+# trigrams of each word, padded so word starts and ends count, e.g. "abba" -> " ab", "abb", "bba", "ba "
+def get_grams(string: str):
+    grams = set()
+    for word in normalize(string).split():
+        word = f" {word} "
+        grams.update(word[i:i + 3] for i in range(len(word) - 2))
+    return grams
+
+
+def _add_items(db, entries, source: str):
+    boost = boosts[source]
+    for uri, name, artists in entries:
+        grams = get_grams(" ".join((name, *artists)))
+        row = db.execute("SELECT id, boost FROM items WHERE uri = ?", (uri,)).fetchone()
+        if row:
+            if boost > row[1]:
+                db.execute("UPDATE items SET boost = ? WHERE id = ?", (boost, row[0]))
+            continue
+        item_id = db.execute("INSERT INTO items (uri, type, name, artists, grams, boost) VALUES (?, ?, ?, ?, ?, ?)",
+                             (uri, uri.split(":")[1], name, json.dumps(artists), len(grams), boost)).lastrowid
+        db.executemany("INSERT OR IGNORE INTO grams VALUES (?, ?)", [(gram, item_id) for gram in grams])
+
+
+def _get_state(db, name: str):
+    row = db.execute("SELECT state FROM sources WHERE name = ?", (name,)).fetchone()
+    return row[0] if row else None
+
+
+def _set_state(db, name: str, state):
+    db.execute("INSERT OR REPLACE INTO sources VALUES (?, ?)", (name, str(state)))
+
+
+def _sync_list(db, name: str, file_path):
+    from spotify_item import Favorites
+
+    state = file_path.stat().st_mtime_ns if file_path.exists() else None
+    if str(state) == _get_state(db, name):
+        return
+    _add_items(db, ((item.uri, item.name, item.artists) for item in Favorites.from_file(file_path)), name)
+    _set_state(db, name, state)
+
+
+def _metadata_entry(uri: str, data: dict):
+    if uri.split(":")[1] == "playlist":
+        return uri, data['name'], [data['owner']['display_name']] if data.get('owner') else []
+    return uri, data['name'], [artist['name'] for artist in data.get('artists', [])]
+
+
+# metadata fetched since the last sync
+def _sync_metadata(db):
+    import metadata_cache
+
+    rows = metadata_cache.get_fetched_since(float(_get_state(db, "metadata") or 0))
+    if rows:
+        _add_items(db, (_metadata_entry(uri, data) for uri, data, _ in rows if data), "metadata")
+        _set_state(db, "metadata", max(fetched for _, _, fetched in rows))
+
+
+# the catalogue is reindexed whenever a playlist in it changed
+def _sync_catalogue(db):
+    import catalogue
+
+    state = json.dumps(sorted(catalogue.get_snapshots().items()))
+    if state == _get_state(db, "catalogue"):
+        return
+    _add_items(db, ((track.uri, track.name, track.artists) for track, _ in catalogue.get_tracks()), "catalogue")
+    _set_state(db, "catalogue", state)
+
+
+# indexes whatever was added to the sources since the last sync
+def sync():
+    import tracing
+    from util import favorites_file, my_playlists_file
+
+    with tracing.span("search index sync"), _lock:
+        db = get_db()
+        _sync_list(db, "favorites", favorites_file)
+        _sync_list(db, "my_playlists", my_playlists_file)
+        _sync_metadata(db)
+        _sync_catalogue(db)
+        db.commit()
+
+
+# records a track seen playing, indexed on flush
+def remember(item):
+    if item.uri and item.uri.startswith("spotify:"):
+        with _lock:
+            _seen.append((item.uri, item.name, item.artists))
+
+
+def flush():
+    if not _seen:
+        return
+    with _lock:
+        db = get_db()
+        _add_items(db, _seen, "mpris")
+        _seen.clear()
+        db.commit()
+
+
+# the best matching items as (score, uri, name, artists), best first, only of item_type if given
+# score is the share of query trigrams matched plus the item's source boost
+def search(query: str, item_type: str = None, limit: int = 10):
+    grams = get_grams(query)
+    if not grams:
+        return []
+    # filtered after counting, so items of other types never take a candidate's place
+    type_filter = "WHERE i.type = ? " if item_type else ""
+    with _lock:
+        rows = get_db().execute(
+            f"SELECT i.uri, i.name, i.artists, i.grams, i.boost, c.shared FROM "
+            f"(SELECT item, COUNT(*) AS shared FROM grams WHERE gram IN ({','.join('?' * len(grams))}) "
+            f"GROUP BY item) c JOIN items i ON i.id = c.item {type_filter}ORDER BY c.shared DESC LIMIT ?",
+            (*grams, *((item_type,) if item_type else ()), max_candidates)).fetchall()
+
+    results = []
+    for uri, name, artists, item_grams, boost, shared in rows:
+        coverage = shared / len(grams)
+        if coverage < min_coverage:
+            continue
+        # of two items covering the query, prefer the one with fewer other words
+        similarity = shared / (len(grams) + item_grams - shared)
+        results.append((coverage + 0.5 * similarity + boost, uri, name, json.loads(artists)))
+    return sorted(results, reverse=True)[:limit]
+
+
+# the uri of the best match for query, or None if nothing seen so far matches well enough
+# a query matching only part of a name, e.g. "yesterday" for "Yesterday Once More", is left to the web search
+def lookup(query: str, item_type: str = None):
+    grams = get_grams(query)
+    for score, uri, name, artists in search(query, item_type):
+        name_grams = get_grams(name)
+        if name_grams and len(grams & name_grams) / len(name_grams) >= min_name_coverage:
+            return uri
+    return None
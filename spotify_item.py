@@ -1,12 +1,11 @@
+from collections import OrderedDict
 from pathlib import Path
 from typing import List
 
-from util import get_spotify, play_uri, get_best_img_from_list, save_img_url, add_icon_to_str
-
 
 class SpotifyItem:
+    __slots__ = ("name", "artists", "uri", "_img_url")
     type: str = None
-    _img_url: str = None
 
     def __init__(self, name: str, artists: list, uri: str, img_url: str = None):
         self.name = name
@@ -18,18 +17,23 @@ class SpotifyItem:
         return self.uri.split(":")[-1]
 
     def play(self):
+        from util import play_uri
         if self.uri:
             print(f"Playing {repr(self)}")
             play_uri(self.uri)
         else:
             raise Exception(f"No uri available for {self}")
 
-    # cache_dir/id.jpg
+    # cache_dir/thumbs/digest.jpg, shared by every item using the same image
+    # None if the image url isn't known and no thumbnail was saved for this item yet
     def get_img_path(self):
-        from util import cache_dir, img_ext
-        return cache_dir / f"{self.get_id()}.{img_ext}"
+        import thumbnails
+        if self._img_url:
+            return thumbnails.get_path(self._img_url)
+        return thumbnails.get_item_path(self.uri)
 
     def get_img_url(self):
+        from util import get_best_img_from_list
         if not self._img_url and self.uri:
             images = self.get_data(self.uri)['images']
             best_img = get_best_img_from_list(images)
@@ -38,14 +42,15 @@ class SpotifyItem:
         return self._img_url
 
     def is_img_saved(self):
-        path = self.get_img_path()
-        return path and path.exists()
+        import thumbnails
+        return thumbnails.is_saved(self.get_img_path())
 
-    def save_img(self):
+    def save_img(self, timeout: float = None):
+        import thumbnails
         img_url = self.get_img_url()
         if img_url:
             print(f"Saving image for {self}")
-            save_img_url(self.get_img_url(), self.get_img_path())
+            thumbnails.save(img_url, self.uri, timeout)
         else:
             print(f"Could not find image url for {self}")
 
@@ -76,9 +81,9 @@ class SpotifyItem:
         artists = fields[2].split(',') if fields[2] else []
         uri = fields[3]
 
-        for _class in (Playlist, Album, Artist, Track):
-            if _class.type == type:
-                return _class(name=name, artists=artists, uri=uri)
+        _class = item_classes.get(type)
+        if _class:
+            return _class(name=name, artists=artists, uri=uri)
 
     @staticmethod
     def from_uri(uri: str):
@@ -90,6 +95,33 @@ class SpotifyItem:
                 return _class.from_data(_class.get_data(uri))
         raise (TypeError(f"Invalid item type: {uri_type}"))
 
+    # fetches many items at once, grouping uris by type into the multi-id endpoints
+    # returns the items in the order of uris, skipping any that could not be found
+    @staticmethod
+    def from_uris(uris: List[str]):
+        from concurrent.futures import ThreadPoolExecutor
+        from util import get_uri_type, img_fetch_workers
+
+        batches = []
+        for _class in (Playlist, Album, Artist, Track):
+            class_uris = [uri for uri in uris if get_uri_type(uri) == _class.type]
+            for i in range(0, len(class_uris), _class.batch_size):
+                batches.append((_class, class_uris[i:i + _class.batch_size]))
+        invalid = {get_uri_type(uri) for uri in uris} - {_class.type for _class in (Playlist, Album, Artist, Track)}
+        if invalid:
+            raise (TypeError(f"Invalid item type: {', '.join(invalid)}"))
+
+        def fetch(batch):
+            _class, batch_uris = batch
+            return [_class.from_data(data) for data in _class.get_data_batch(batch_uris) if data]
+
+        items = {}
+        with ThreadPoolExecutor(max_workers=img_fetch_workers) as executor:
+            for batch_items in executor.map(fetch, batches):
+                items.update((item.uri, item) for item in batch_items)
+
+        return [items[uri] for uri in uris if uri in items]
+
     @staticmethod
     def get_data(uri: str):
         uri_type = uri.split(':')[1]
@@ -100,57 +132,100 @@ class SpotifyItem:
 
 
 class Playlist(SpotifyItem):
+    __slots__ = ()
     type = "playlist"
-
-    def add_item(self, item: SpotifyItem):
+    # no multi-id endpoint for playlists
+    batch_size = 1
+    # only the fields needed for the uri index, to keep pages small
+    uri_index_fields = "items(track(uri)),total,limit"
+
+    # checked: the (snapshot_id, contains) returned by check_uri for the item if it was already checked
+    # returns whether the item was added, notify=False leaves notifying to the caller
+    def add_item(self, item: SpotifyItem, checked: tuple = None, notify=True):
+        import catalogue
         from util import notify_send, get_spotify
 
-        if self.contains_uri(item.uri):
-            notify_send(f"Playlist {self.name} already contains song\n{str(item)}")
-        else:
-            get_spotify().playlist_add_items(self.uri, [item.uri])
+        checked_snapshot_id, contains = checked if checked is not None else self.check_uri(item.uri)
+        if contains:
+            if notify:
+                notify_send(f"Playlist {self.name} already contains song\n{str(item)}")
+            return False
+        snapshot_id = get_spotify().playlist_add_items(self.uri, [item.uri])['snapshot_id']
+        self.update_uri_index(checked_snapshot_id, snapshot_id, [item.uri])
+        catalogue.add_track(self.uri, checked_snapshot_id, snapshot_id, item)
+        if notify:
             notify_send(f"Added track to {self.name}\n{str(item)}", image=self.get_img_path())
+        return True
 
+    # yields the tracks in playlist order as pages arrive, pages are fetched concurrently once the first gives the total
+    def get_items(self, **kwargs):
+        from util import get_async_spotify, iter_async
 
-
-    def get_items(self):
-        from util import get_spotify
-        spotify = get_spotify()
-        data = spotify.playlist_items(self.uri)
-
-        items: List[SpotifyItem] = []
-
-        while True:
-            for item in data['items']:
-                item = item['track']
-                if item:
-                    items.append(Track.from_data(item))
-            if data['next']:
-                data = spotify.next(data)
-            else:
-                break
-
-        return items
+        for page in iter_async(get_async_spotify().iter_pages("playlist_items", self.uri, **kwargs)):
+            for item in page:
+                if item['track']:
+                    yield Track.from_data(item['track'])
 
     def contains_uri(self, uri: str):
+        return self.check_uri(uri)[1]
+
+    # (snapshot_id, whether the playlist contains uri), from the saved index if it is current, otherwise paging
+    # through the playlist until the first hit
+    # after a hit the remaining pages are read in the background, so the index is saved either way
+    def check_uri(self, uri: str):
+        import thumbnails
+        from util import get_async_spotify, iter_async, read_json
+
+        snapshot_id = self.get_snapshot_id()
+        index = read_json(self.get_index_path())
+        if index and index['snapshot_id'] == snapshot_id:
+            return snapshot_id, uri in index['uris']
+
+        pages = iter_async(get_async_spotify().iter_pages("playlist_items", self.uri, fields=self.uri_index_fields,
+                                                          additional_types=("track",)))
+        uris = set()
+        for page in pages:
+            uris.update(item['track']['uri'] for item in page if item['track'] and item['track'].get('uri'))
+            if uri in uris:
+                thumbnails.fetch_in_background(self._finish_uri_index, snapshot_id, uris, pages, name="uri-index")
+                return snapshot_id, True
+        self._finish_uri_index(snapshot_id, uris, pages)
+        return snapshot_id, False
+
+    # reads the rest of pages into uris and saves them as the index at snapshot_id
+    def _finish_uri_index(self, snapshot_id: str, uris: set, pages):
+        from util import write_json
+
+        for page in pages:
+            uris.update(item['track']['uri'] for item in page if item['track'] and item['track'].get('uri'))
+        write_json(self.get_index_path(), {'snapshot_id': snapshot_id, 'uris': list(uris)})
+
+    def get_snapshot_id(self):
         from util import get_spotify
-        spotify = get_spotify()
-        data = spotify.playlist_items(self.uri)
-
-        while True:
-            for item in data['items']:
-                item = item['track']
-                if item:
-                    item_uri = item['uri']
-                    if item_uri == uri:
-                        return True
-            if data['next']:
-                data = spotify.next(data)
-            else:
-                return False
+        return get_spotify().playlist(self.uri, fields="snapshot_id")['snapshot_id']
+
+    # cache_dir/playlists/id.json
+    def get_index_path(self):
+        from util import playlist_index_dir
+        return playlist_index_dir / f"{self.get_id()}.json"
+
+    # applies our own additions to the saved index, moving it to the snapshot returned by the add call
+    # checked_snapshot_id: the snapshot the playlist was checked against before adding, an index at another one
+    # misses changes made elsewhere and is left stale, so the next check pages through the playlist
+    def update_uri_index(self, checked_snapshot_id: str, snapshot_id: str, added_uris: List[str]):
+        from util import read_json, write_json
+
+        path = self.get_index_path()
+        index = read_json(path)
+        if not index or index['snapshot_id'] != checked_snapshot_id:
+            return
+        uris = set(index['uris'])
+        uris.update(added_uris)
+        write_json(path, {'snapshot_id': snapshot_id, 'uris': list(uris)})
 
     @staticmethod
     def from_data(data):
+        from util import get_best_img_from_list
         img_url = None
         if 'images' in data:
             img_url = get_best_img_from_list(data['images'])['url']
@@ -158,14 +233,23 @@ class Playlist(SpotifyItem):
 
     @staticmethod
     def get_data(uri):
-        return get_spotify().playlist(uri, fields="uri, name, owner, images")
+        import metadata_cache
+        from util import get_spotify
+        return metadata_cache.get(uri, lambda uri: get_spotify().playlist(uri, fields="uri, name, owner, images"))
+
+    @staticmethod
+    def get_data_batch(uris: List[str]):
+        return [Playlist.get_data(uri) for uri in uris]
 
 
 class Album(SpotifyItem):
+    __slots__ = ()
     type = "album"
+    batch_size = 20
 
     @staticmethod
     def from_data(data: dict):
+        from util import get_best_img_from_list
         img_url = None
         artists = [artist['name'] for artist in data['artists']]
         if 'images' in data:
@@ -176,14 +260,25 @@ class Album(SpotifyItem):
 
     @staticmethod
     def get_data(uri):
-        return get_spotify().album(uri)
+        import metadata_cache
+        from util import get_spotify
+        return metadata_cache.get(uri, lambda uri: get_spotify().album(uri))
+
+    @staticmethod
+    def get_data_batch(uris: List[str]):
+        import metadata_cache
+        from util import get_spotify
+        return metadata_cache.get_many(uris, lambda uris: get_spotify().albums(uris)['albums'])
 
 
 class Artist(SpotifyItem):
+    __slots__ = ()
     type = "artist"
+    batch_size = 50
 
     @staticmethod
     def from_data(data):
+        from util import get_best_img_from_list
         img_url = None
         if 'images' in data:
             img_url = get_best_img_from_list(data['images'])['url']
@@ -191,49 +286,60 @@ class Artist(SpotifyItem):
 
     @staticmethod
     def get_data(uri):
-        return get_spotify().artist(uri)
+        import metadata_cache
+        from util import get_spotify
+        return metadata_cache.get(uri, lambda uri: get_spotify().artist(uri))
+
+    @staticmethod
+    def get_data_batch(uris: List[str]):
+        import metadata_cache
+        from util import get_spotify
+        return metadata_cache.get_many(uris, lambda uris: get_spotify().artists(uris)['artists'])
 
 
 class Track(SpotifyItem):
+    __slots__ = ("album",)
     type = "track"
+    batch_size = 50
 
     def __init__(self, name: str, artists: list, uri: str, img_url: str = None, album: Album = None):
         super().__init__(name, artists, uri, img_url)
         self.album = album
 
+    # saving and removing are idempotent, so they are sent whatever the mirror says, which may be behind
     def save(self):
-        from util import notify_send
+        import library
+        from util import notify_send, get_spotify
 
-        spotify = get_spotify()
-        if self.is_saved():
-            notify_send(f"Song already saved:\n{self}")
-        else:
-            spotify.current_user_saved_tracks_add([self.uri])
-            notify_send(f"Saved song:\n{self}")
+        get_spotify().current_user_saved_tracks_add([self.uri])
+        library.set_saved(self.uri, True)
+        notify_send(f"Saved song:\n{self}")
 
     def unsave(self):
-        from util import notify_send
+        import library
+        from util import notify_send, get_spotify
 
-        spotify = get_spotify()
-        if not self.is_saved():
-            notify_send(f"Cannot remove song:\n{self}\nSong is not saved")
-        else:
-            spotify.current_user_saved_tracks_delete([self.uri])
-            notify_send(f"Removed song:\n{self}")
+        get_spotify().current_user_saved_tracks_delete([self.uri])
+        library.set_saved(self.uri, False)
+        notify_send(f"Removed song:\n{self}")
 
+    # answered from the local mirror of saved tracks, as of its last sync
     def is_saved(self):
-        return get_spotify().current_user_saved_tracks_contains([self.uri])[0]
+        import library
+        return library.is_saved(self.uri)
 
     def get_img_url(self):
+        from util import get_best_img_from_list
         if not self._img_url:
-            images = get_spotify().album(self.uri)['images']
+            images = Track.get_data(self.uri)['album']['images']
             self._img_url = get_best_img_from_list(images)['url']
         return self._img_url
 
     def get_img_path(self):
-        if self.album and self.album.uri:
+        path = super().get_img_path()
+        if not path and self.album and self.album.uri:
             return self.album.get_img_path()
-        return super().get_img_path()
+        return path
 
     @staticmethod
     def from_data(data):
@@ -247,72 +353,246 @@ class Track(SpotifyItem):
 
     @staticmethod
     def get_data(uri):
-        return get_spotify().track(uri)
+        import metadata_cache
+        from util import get_spotify
+        return metadata_cache.get(uri, lambda uri: get_spotify().track(uri))
+
+    @staticmethod
+    def get_data_batch(uris: List[str]):
+        import metadata_cache
+        from util import get_spotify
+        return metadata_cache.get_many(uris, lambda uris: get_spotify().tracks(uris)['tracks'])
+
+
+item_classes = {_class.type: _class for _class in (Playlist, Album, Artist, Track)}
 
 
-# manages lists of SpotifyItems
+# manages ordered lists of SpotifyItems, indexed by uri so lookups and reordering don't scan the list
+# with a usage log, the menu order is by frecency of plays and adds, then by order in the file
 class Favorites:
 
-    def __init__(self, items: List[SpotifyItem]):
-        self.items = items
+    def __init__(self, items: List[SpotifyItem], usage=None):
+        self._items = OrderedDict()
+        self.usage = usage
+        for item in items:
+            self.add_item(item)
 
+    # the items in menu order
+    @property
+    def items(self) -> List[SpotifyItem]:
+        return list(self._items.values())
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(self._items.values())
+
+    def __contains__(self, uri: str):
+        return uri in self._items
+
+    # adds item to the end, replacing any item with the same uri
     def add_item(self, item):
-        self.items.append(item)
+        self._items.pop(item.uri, None)
+        self._items[item.uri] = item
 
     def add_uri(self, uri: str):
         # allows usage with uri
-        duplicates = filter(lambda item: item.uri == uri, self.items)
-        for dupe in duplicates:
-            print(f"Found duplicate: {dupe}")
-            self.remove_item(dupe)
+        if uri in self._items:
+            print(f"Found duplicate: {self._items[uri]}")
 
         item = SpotifyItem.from_uri(uri)
         self.add_item(item)
         if not item.is_img_saved(): item.save_img()
 
+    # adds many uris with one batched metadata fetch and concurrent image downloads
+    # uris already in the list are moved to the end, like add_uri
+    def add_uris(self, uris):
+        uris = list(dict.fromkeys(uris))
+        new_items = SpotifyItem.from_uris(uris)
+
+        for item in new_items:
+            self.add_item(item)
+        if self.usage and new_items:
+            self.usage.record([("add", item.uri) for item in new_items], keep=self)
+            self.sort_by_usage()
+        Favorites(new_items).save_all_images()
+        return new_items
+
     def remove_item(self, item):
         print(f"Removing {item}")
-        self.items.remove(item)
+        del self._items[item.uri]
 
     def play_random(self):
         import random
         random.choice(self.items).play()
 
     def bring_to_top(self, item: SpotifyItem):
-        self.items.insert(0, self.items.pop(self.items.index(item)))
+        self._items.move_to_end(item.uri, last=False)
 
-    # saves images of all items if they aren't already in cache
+    # appends the play to the usage log and moves item up by its new score, the list file is left as is
+    def record_play(self, item: SpotifyItem):
+        if self.usage:
+            self.usage.record([("play", item.uri)], keep=self)
+            self.sort_by_usage()
+        else:
+            self.bring_to_top(item)
+
+    # stable, so items with equal scores (e.g. never played) keep their order
+    def sort_by_usage(self):
+        scores = self.usage.scores
+        if scores:
+            items = sorted(self._items.values(), key=lambda item: -scores.get(item.uri, 0))
+            self._items = OrderedDict((item.uri, item) for item in items)
+
+    # picks up usage recorded since the log was last read, e.g. plays since a snapshot was taken
+    # returns display_list reordered to match
+    def refresh_usage(self, display_list: List[str]):
+        if not self.usage or not self.usage.refresh():
+            return display_list
+        uris = list(self._items)
+        self.sort_by_usage()
+        rows = dict(zip(uris, display_list))
+        return [rows[uri] for uri in self._items]
+
+    # saves images of all items if they aren't already in cache, returns False if any fetch failed
+    # fetches run on a thread pool so a slow or failing image does not hold up the others
     def save_all_images(self):
-        for item in self.items:
-            if not item.is_img_saved():
-                item.save_img()
+        import thumbnails
+        import tracing
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+        from time import perf_counter
+        from util import img_fetch_workers, img_fetch_timeout
+
+        missing = [item for item in self if not item.is_img_saved()]
+        if not missing:
+            return True
+
+        start = perf_counter()
+        failed = 0
+        with tracing.span("image prefetch", images=len(missing)), \
+                ThreadPoolExecutor(max_workers=img_fetch_workers) as executor:
+            futures = {executor.submit(item.save_img, img_fetch_timeout): item for item in missing}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    failed += 1
+                    print(f"Could not save image for {futures[future]}: {e}")
+
+        thumbnails.flush()
+        print(f"Fetched {len(missing) - failed}/{len(missing)} images in {perf_counter() - start:.2f}s "
+              f"({img_fetch_workers} workers)")
+        return failed == 0
 
     # dictionary from str(item) to item for rofi menus
     # detail: 2: include name, type and artist
     #         1: include name and artist
     #         0: include name
+    # items whose image isn't cached yet get placeholder_icon
     def get_display_list(self, detail=2):
+        import thumbnails
+        from util import add_icon_to_str, placeholder_icon
         if detail == 0:
             to_str = lambda s: s.name
         elif detail == 1:
             to_str = lambda s: str(s)
         else:
             to_str = lambda s: repr(s)
-        return [add_icon_to_str(to_str(item), item.get_img_path()) for item in
-                self.items]
-
+        display_list = []
+        saved = thumbnails.get_saved_digests()
+        for item in self:
+            img_path = item.get_img_path()
+            display_list.append(add_icon_to_str(to_str(item), img_path if img_path and img_path.stem in saved
+                                                else placeholder_icon))
+        return display_list
+
+    # writes to a temporary file first so an interrupted write never loses the list
     def write(self, file_path: Path):
-        with file_path.open("w") as f:
-            f.writelines([item.to_file_entry() for item in self.items])
+        import os
+        tmp_path = file_path.with_name(file_path.name + ".tmp")
+        with tmp_path.open("w") as f:
+            f.writelines([item.to_file_entry() for item in self])
+        os.replace(tmp_path, file_path)
+
+    # pickles the items and their rendered rofi rows so unchanged menus skip parsing and image checks
+    def write_snapshot(self, file_path: Path, detail=2):
+        import pickle
+
+        display_list = self.get_display_list(detail)
+        snapshot = {'key': Favorites.get_snapshot_key(file_path, detail), 'favs': self, 'display_list': display_list}
+        with Favorites.get_snapshot_path(file_path, detail).open("wb") as f:
+            pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+        return display_list
+
+    # cache_dir/stem.detail.pickle
+    @staticmethod
+    def get_snapshot_path(file_path: Path, detail: int):
+        from util import cache_dir
+        return cache_dir / f"{file_path.stem}.{detail}.pickle"
+
+    # a snapshot is valid while the file is unchanged and the same images are in the cache
+    @staticmethod
+    def get_snapshot_key(file_path: Path, detail: int):
+        import os
+        from util import thumbs_dir
+
+        stat = file_path.stat() if file_path.exists() else None
+        images = frozenset(os.listdir(thumbs_dir))
+        return (str(file_path), stat and stat.st_mtime_ns, stat and stat.st_size, detail, images)
+
+    # returns the items in file_path along with their display list, without waiting for missing images
+    # the snapshot key covers the cached images, so images saved later (see fetch_images) refresh the snapshot
+    @staticmethod
+    def load_for_menu(file_path: Path, detail=2):
+        import pickle
+        import tracing
+
+        key = Favorites.get_snapshot_key(file_path, detail)
+        try:
+            with tracing.span(f"load {file_path.name} snapshot"), \
+                    Favorites.get_snapshot_path(file_path, detail).open("rb") as f:
+                snapshot = pickle.load(f)
+            if snapshot['key'] == key:
+                favs = snapshot['favs']
+                return favs, favs.refresh_usage(snapshot['display_list'])
+        except Exception:
+            # missing, stale or unreadable snapshot, rebuild it below
+            pass
+
+        favs = Favorites.from_file(file_path)
+        return favs, favs.write_snapshot(file_path, detail)
+
+    # saves missing images in the background while a menu is open, their icons show from the next launch
+    # skipped under --cache-only, the placeholder icons stay until a launch that may download
+    # skipped when display_list (from load_for_menu) shows no placeholder icon, so no image can be missing
+    def fetch_images(self, display_list: list):
+        import metadata_cache
+        import thumbnails
+        from util import add_icon_to_str, placeholder_icon
+        placeholder = add_icon_to_str("", placeholder_icon)
+        if metadata_cache.cache_only or not any(row.endswith(placeholder) for row in display_list):
+            return
+        thumbnails.fetch_in_background(self.save_all_images)
+
+    # the usage log next to the list file, e.g. favorites.log
+    @staticmethod
+    def get_log_path(file_path: Path):
+        return file_path.with_suffix(".log")
 
     @staticmethod
     def from_file(file_path: Path):
+        import tracing
+        from usage_log import UsageLog
 
-        favs = Favorites([])
+        favs = Favorites([], usage=UsageLog(Favorites.get_log_path(file_path)))
         if file_path.exists():
-            with file_path.open("r") as f:
+            with tracing.span(f"parse {file_path.name}"), file_path.open("r") as f:
                 for line in f:
                     favs.add_item(SpotifyItem.from_file_entry(line))
+        with tracing.span(f"read {favs.usage.path.name}"):
+            favs.usage.refresh()
+            favs.sort_by_usage()
 
         return favs
 
@@ -322,10 +602,11 @@ class Favorites:
         import re
         regex = re.compile(r"spotify:[a-z]*:[a-zA-Z0-9]+")
 
-        favs = Favorites([])
-        with file_path.open("r") as f:
-            for line in f:
-                for uri in regex.findall(line):
-                    favs.add_uri(uri)
+        def find_uris():
+            with file_path.open("r") as f:
+                for line in f:
+                    yield from regex.findall(line)
 
+        favs = Favorites([])
+        favs.add_uris(find_uris())
         return favs
@@ -1,4 +1,29 @@
-from util import get_uri_from_url
+# web searches for spotify items, cached per normalized query in web_searches.db
+# identical searches started at the same time, e.g. by repeated keypresses, wait for the first one's result
+import sqlite3
+import threading
+from time import time
+
+from util import get_uri_from_url, web_searches_file, search_locks_dir
+
+# seconds before a query is searched again, and before a search that found nothing is retried
+ttl = 7 * 24 * 60 * 60
+negative_ttl = 10 * 60
+# queries share lock files by hash, so the lock folder stays bounded
+lock_buckets = 256
+
+_db = None
+_lock = threading.Lock()
+
+
+def get_db():
+    global _db
+    if not _db:
+        _db = sqlite3.connect(web_searches_file, check_same_thread=False)
+        _db.execute("PRAGMA journal_mode=WAL")
+        _db.execute("CREATE TABLE IF NOT EXISTS searches "
+                    "(query TEXT, type TEXT, uri TEXT, fetched REAL, PRIMARY KEY (query, type))")
+    return _db
 
 
 def search(query: str, type="track"):
@@ -10,9 +35,73 @@ def search(query: str, type="track"):
     return next(search(query, num=1, start=0, stop=0))
 
 
+# (uri,) with uri None for a search that found nothing, or None if the query isn't cached or expired
+def _get_cached(query: str, type: str):
+    with _lock:
+        row = get_db().execute("SELECT uri, fetched FROM searches WHERE query = ? AND type = ?",
+                               (query, type or "")).fetchone()
+    if row and time() - row[1] < (ttl if row[0] else negative_ttl):
+        return row[0],
+    return None
+
+
+def _store(query: str, type: str, uri):
+    with _lock:
+        db = get_db()
+        db.execute("INSERT OR REPLACE INTO searches VALUES (?, ?, ?, ?)", (query, type or "", uri, time()))
+        # committed right away, other processes waiting on the query read it next
+        db.commit()
+
+
+# held while searching for query, across threads and processes
+class _QueryLock:
+
+    def __init__(self, query: str, type: str):
+        import zlib
+        self.path = search_locks_dir / f"{zlib.crc32(f'{type}:{query}'.encode()) % lock_buckets:02x}.lock"
+        self._file = None
+
+    def __enter__(self):
+        import fcntl
+        self._file = self.path.open("w")
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *_):
+        self._file.close()
+
+
+# the uri of the first web result for query, or None if there is none
+def find_uri(query: str, type="track"):
+    import search_index
+    import tracing
+
+    # only the cache is keyed by the normalized query, the search gets it as typed
+    key = search_index.normalize(query) or query
+    cached = _get_cached(key, type)
+    if cached:
+        return cached[0]
+    with _QueryLock(key, type):
+        # searched by whoever held the lock before us
+        cached = _get_cached(key, type)
+        if cached:
+            return cached[0]
+        with tracing.span("web search", "http"):
+            try:
+                uri = get_uri_from_url(search(query, type))
+            except StopIteration:
+                uri = None
+        _store(key, type, uri)
+    return uri
+
+
+# plays the best match from the local search index, searching the web only for items never seen before
 def play_search(query: str, type="track"):
-    from util import play_uri
+    import search_index
+    from util import notify_send, play_uri
 
-    url = search(query, type)
-    uri = get_uri_from_url(url)
+    uri = search_index.lookup(query, type) or find_uri(query, type)
+    if not uri:
+        notify_send(f"No results for {query}")
+        return
     play_uri(uri)
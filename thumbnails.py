@@ -0,0 +1,344 @@
+# content-addressed image cache: thumbnails are stored once per image, named by a hash of the image url,
+# and items (by uri) reference the thumbnail they use
+# thumbs.db also tracks each thumbnail's size and last access, so the cache can be held to a size budget
+# by evicting the least recently used thumbnails without scanning the directory
+import hashlib
+import re
+import sqlite3
+import threading
+from pathlib import Path
+from time import time
+
+import tracing
+from util import thumbs_dir, thumbs_db_file, img_ext, flush_accessed
+
+# i.scdn.co image ids start with a 16 character prefix: 8 for the image kind and 8 for its size
+# album covers (ab67616d) come in 64, 300 and 640px, which all share the rest of the id
+_scdn_id = re.compile(r"^https?://(?:i\.scdn\.co|open\.spotify\.com)/image/(ab67616d)([0-9a-f]{8})([0-9a-f]+)$")
+_cover_300 = "00001e02"
+# the size ids by width
+_cover_sizes = {64: "00004851", 300: _cover_300, 640: "0000b273"}
+
+_db = None
+_item_digests = None
+_lock = threading.Lock()
+_url_locks = {}
+_sizes = None
+_accessed = {}
+_hits = 0
+_misses = 0
+# downloads started for an open menu, see fetch_in_background
+_fetches = []
+
+
+def get_db():
+    global _db
+    if not _db:
+        _db = sqlite3.connect(thumbs_db_file, check_same_thread=False)
+        # inserts are committed one by one as thumbnails are saved, so they must be cheap
+        _db.execute("PRAGMA journal_mode=WAL")
+        _db.execute("PRAGMA synchronous=NORMAL")
+        _db.execute("CREATE TABLE IF NOT EXISTS item_thumbs (uri TEXT PRIMARY KEY, digest TEXT)")
+        _db.execute("CREATE TABLE IF NOT EXISTS thumbs (digest TEXT PRIMARY KEY, size INTEGER, accessed REAL)")
+        _db.execute("CREATE INDEX IF NOT EXISTS thumbs_accessed ON thumbs (accessed)")
+        _db.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)")
+    return _db
+
+
+# maps the differently sized or hosted urls of the same cover (e.g. the 640px MPRIS art url and the 300px
+# Web API url) to a single url, the 300px one, so a cover has one digest whichever size it is downloaded in
+def normalize_url(img_url: str):
+    match = _scdn_id.match(img_url)
+    if match:
+        return f"https://i.scdn.co/image/{match.group(1)}{_cover_300}{match.group(3)}"
+    return img_url
+
+
+# the url of the smallest cover variant above the largest thumbnail size (as util.get_best_img_from_list picks),
+# so thumbnails are only ever scaled down, e.g. the 640px cover once a size over 300 is configured
+def get_download_url(img_url: str):
+    match = _scdn_id.match(img_url)
+    if not match:
+        return img_url
+    largest = max(get_sizes())
+    width = min((width for width in _cover_sizes if width > largest), default=max(_cover_sizes))
+    return f"https://i.scdn.co/image/{match.group(1)}{_cover_sizes[width]}{match.group(3)}"
+
+
+def get_digest(img_url: str):
+    return hashlib.sha1(normalize_url(img_url).encode()).hexdigest()[:20]
+
+
+# cache_dir/thumbs/digest.jpg
+def get_path(img_url: str):
+    return thumbs_dir / f"{get_digest(img_url)}.{img_ext}"
+
+
+# the configured thumbnail sizes, read once
+def get_sizes():
+    global _sizes
+    if _sizes is None:
+        from util import get_setting, thumb_sizes
+        _sizes = [int(size) for size in get_setting("Cache", "thumb_sizes", thumb_sizes).replace(",", " ").split()]
+        for size in _sizes[1:]:
+            (thumbs_dir / str(size)).mkdir(exist_ok=True)
+    return _sizes
+
+
+# {size: path} of every size of a thumbnail, the first size at thumbs/digest.jpg and the others at
+# thumbs/size/digest.jpg
+def get_size_paths(digest: str):
+    sizes = get_sizes()
+    paths = {size: thumbs_dir / str(size) / f"{digest}.{img_ext}" for size in sizes[1:]}
+    paths[sizes[0]] = thumbs_dir / f"{digest}.{img_ext}"
+    return paths
+
+
+def _load_item_digests():
+    global _item_digests
+    if _item_digests is None:
+        _item_digests = dict(get_db().execute("SELECT uri, digest FROM item_thumbs").fetchall())
+    return _item_digests
+
+
+# the thumbnail last saved for uri, or None if there is none yet
+def get_item_path(uri: str):
+    with _lock:
+        digest = _load_item_digests().get(uri)
+    if digest:
+        return thumbs_dir / f"{digest}.{img_ext}"
+    return None
+
+
+def set_item_digest(uri: str, digest: str):
+    with _lock:
+        if _load_item_digests().get(uri) == digest:
+            return
+        _item_digests[uri] = digest
+        db = get_db()
+        db.execute("INSERT OR REPLACE INTO item_thumbs VALUES (?, ?)", (uri, digest))
+        # committed right away, saves run in the background while a menu is open
+        db.commit()
+
+
+# checks that a thumbnail exists, counting the lookup as a cache hit or miss
+def is_saved(path: Path):
+    global _hits, _misses
+    if path and path.exists():
+        with _lock:
+            _hits += 1
+            _accessed[path.stem] = time()
+        return True
+    with _lock:
+        _misses += 1
+    return False
+
+
+# downloads img_url unless its thumbnail already exists and records it as the thumbnail for uri
+# concurrent saves of the same image wait for a single download
+def save(img_url: str, uri: str = None, timeout: float = None) -> Path:
+    from util import download_img, save_thumbnails
+
+    digest = get_digest(img_url)
+    path = get_path(img_url)
+    with _lock:
+        url_lock = _url_locks.setdefault(digest, threading.Lock())
+    with url_lock:
+        if not path.exists():
+            if timeout:
+                data = download_img(get_download_url(img_url), timeout=timeout)
+            else:
+                data = download_img(get_download_url(img_url))
+            _record(digest, save_thumbnails(data, get_size_paths(digest)))
+    if uri:
+        set_item_digest(uri, digest)
+    return path
+
+
+# size: the bytes taken by every size of the thumbnail
+def _record(digest: str, size: int):
+    with _lock:
+        db = get_db()
+        db.execute("INSERT OR REPLACE INTO thumbs VALUES (?, ?, ?)", (digest, size, time()))
+        db.commit()
+
+
+# saves the thumbnails of many images at once, e.g. every cover in the catalogue
+# images is a list of (img_url, uri), with uri None for images not used by an item
+# downloads run on threads and decoding on a pool of processes, so decoding isn't held to one core by the GIL
+# images with every size already saved are skipped, so warming after adding a size only makes that size
+def warm(images: list, processes: int = None):
+    import multiprocessing
+    from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+    from time import perf_counter
+    from util import download_img, save_thumbnails, img_fetch_workers
+
+    start = perf_counter()
+    missing = {}
+    for img_url, uri in images:
+        digest = get_digest(img_url)
+        if uri:
+            set_item_digest(uri, digest)
+        if digest not in missing and not all(path.exists() for path in get_size_paths(digest).values()):
+            missing[digest] = get_download_url(img_url)
+
+    failed = 0
+    # the decoders start from a fork server, not by forking this process and the threads it runs (e.g. in the daemon)
+    with ThreadPoolExecutor(max_workers=img_fetch_workers) as downloads, \
+            ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("forkserver")) \
+            as decoders:
+        fetches = {downloads.submit(download_img, img_url): digest for digest, img_url in missing.items()}
+        decodes = {}
+        for future in as_completed(fetches):
+            try:
+                decodes[decoders.submit(save_thumbnails, future.result(),
+                                        get_size_paths(fetches[future]))] = fetches[future]
+            except Exception as e:
+                failed += 1
+                print(f"Could not download {missing[fetches[future]]}: {e}")
+        for future in as_completed(decodes):
+            try:
+                _record(decodes[future], future.result())
+            except Exception as e:
+                failed += 1
+                print(f"Could not decode {missing[decodes[future]]}: {e}")
+
+    flush()
+    print(f"Saved {len(missing) - failed}/{len(missing)} images in {perf_counter() - start:.2f}s "
+          f"({len(get_sizes())} sizes each)")
+    return len(missing) - failed
+
+
+# writes access times and counters, then evicts if the cache went over budget
+def flush():
+    global _hits, _misses
+    if not _db:
+        return
+    with _lock:
+        if not flush_accessed(_db, "thumbs", "digest", _accessed, _hits, _misses, "image cache"):
+            return
+        _hits = _misses = 0
+    evict()
+
+
+# runs fn (e.g. Favorites.save_all_images) on a background thread so a menu can open without waiting for it
+# also used for other fetches the process should finish before exiting, e.g. the rest of a playlist's uri index
+def fetch_in_background(fn, *args, name="prefetch-images"):
+    # the daemon never waits for them, so finished ones are dropped here
+    _fetches[:] = [thread for thread in _fetches if thread.is_alive()]
+    _fetches.append(tracing.start_thread(fn, *args, name=name))
+
+
+# waits for the background downloads, so a process exiting after its action still finishes them
+def wait_for_fetches():
+    while _fetches:
+        _fetches.pop().join()
+
+
+# digests of every saved thumbnail, for checking many items without a stat call each
+def get_saved_digests():
+    with _lock:
+        return {digest for digest, in get_db().execute("SELECT digest FROM thumbs").fetchall()}
+
+
+def get_budget():
+    from util import get_setting, thumbs_max_bytes, thumbs_max_files
+    return get_setting("Cache", "max_bytes", thumbs_max_bytes), get_setting("Cache", "max_files", thumbs_max_files)
+
+
+def get_usage():
+    with _lock:
+        count, size = get_db().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM thumbs").fetchone()
+    return count, size
+
+
+# thumbnails used by favorites and my_playlists entries are never evicted
+def get_pinned():
+    from spotify_item import Favorites
+    from util import favorites_file, my_playlists_file
+
+    uris = [item.uri for file_path in (favorites_file, my_playlists_file) for item in Favorites.from_file(file_path)]
+    with _lock:
+        item_digests = _load_item_digests()
+        return {item_digests[uri] for uri in uris if uri in item_digests}
+
+
+# removes the least recently used unpinned thumbnails until the cache is within budget
+def evict():
+    max_bytes, max_files = get_budget()
+    count, size = get_usage()
+    if count <= max_files and size <= max_bytes:
+        return 0
+
+    pinned = get_pinned()
+    evicted = []
+    with _lock:
+        for digest, thumb_size in _db.execute("SELECT digest, size FROM thumbs ORDER BY accessed").fetchall():
+            if count <= max_files and size <= max_bytes:
+                break
+            if digest in pinned:
+                continue
+            evicted.append(digest)
+            count -= 1
+            size -= thumb_size
+
+        # rows first, so a busy database leaves the files in place for the next eviction
+        try:
+            _db.executemany("DELETE FROM thumbs WHERE digest = ?", [(digest,) for digest in evicted])
+            _db.executemany("DELETE FROM item_thumbs WHERE digest = ?", [(digest,) for digest in evicted])
+            _db.commit()
+        except sqlite3.OperationalError as e:
+            _db.rollback()
+            print(f"Could not evict thumbnails: {e}")
+            return 0
+        for digest in evicted:
+            for path in get_size_paths(digest).values():
+                path.unlink(missing_ok=True)
+        evicted_set = set(evicted)
+        for uri in [uri for uri, digest in _load_item_digests().items() if digest in evicted_set]:
+            del _item_digests[uri]
+
+    if evicted:
+        print(f"Evicted {len(evicted)} thumbnails")
+    return len(evicted)
+
+
+# reconciles thumbs.db with the thumbnails directory, removes images left from before thumbnails were
+# content-addressed and evicts to budget
+def compact():
+    from util import cache_dir
+
+    with _lock:
+        db = get_db()
+        known = dict(db.execute("SELECT digest, size FROM thumbs").fetchall())
+        on_disk = {path.stem: path for path in thumbs_dir.glob(f"*.{img_ext}")}
+
+        missing = [digest for digest in known if digest not in on_disk]
+        db.executemany("DELETE FROM thumbs WHERE digest = ?", [(digest,) for digest in missing])
+        for digest, path in on_disk.items():
+            if digest not in known:
+                stat = path.stat()
+                db.execute("INSERT INTO thumbs VALUES (?, ?, ?)", (digest, stat.st_size, stat.st_mtime))
+        db.commit()
+
+    legacy = list(cache_dir.glob(f"*.{img_ext}"))
+    # other sizes of thumbnails that are gone, or of sizes no longer configured
+    sizes = {str(size) for size in get_sizes()[1:]}
+    legacy += [path for path in thumbs_dir.glob(f"*/*.{img_ext}")
+               if path.stem not in on_disk or path.parent.name not in sizes]
+    for path in legacy:
+        path.unlink()
+
+    print(f"Forgot {len(missing)} missing thumbnails, removed {len(legacy)} legacy images")
+    return evict()
+
+
+def get_stats():
+    flush()
+    with _lock:
+        stats = dict(get_db().execute("SELECT name, value FROM stats").fetchall())
+    stats.setdefault('hits', 0)
+    stats.setdefault('misses', 0)
+    stats['files'], stats['bytes'] = get_usage()
+    stats['max_bytes'], stats['max_files'] = get_budget()
+    return stats
@@ -0,0 +1,149 @@
+# per-invocation latency tracing, enabled with --trace
+# spans are written as JSON to cache_dir/traces/ and folded into an aggregated summary per action,
+# so regressions in API call count or latency are visible
+import threading
+from contextlib import contextmanager
+from time import perf_counter, time
+
+# set when this module is first imported, which __main__ does before anything else
+start = perf_counter()
+enabled = False
+# the daemon measures each request from when it arrives instead of from process start
+in_daemon = False
+# traces kept in cache_dir/traces
+max_traces = 100
+
+_spans = []
+_action = None
+_hooked = False
+# counts invocations, so threads left running by one (in the daemon) don't record into the next one's trace
+_invocation = 0
+_local = threading.local()
+# threads started for the traced invocation, waited for before its trace is written
+_threads = []
+
+
+def record(name: str, category: str, span_start: float, duration: float, **attrs):
+    # threads not started through start_thread (e.g. the asyncio client's pool) record for the current invocation
+    if enabled and getattr(_local, 'invocation', _invocation) == _invocation:
+        _spans.append({'name': name, 'category': category, 'start': span_start - start, 'duration': duration,
+                       **attrs})
+
+
+@contextmanager
+def span(name: str, category: str = "app", **attrs):
+    if not enabled:
+        yield
+        return
+    span_start = perf_counter()
+    try:
+        yield
+    finally:
+        record(name, category, span_start, perf_counter() - span_start, **attrs)
+
+
+# a zero length span marking a point in time, e.g. when rofi is shown
+def mark(name: str, **attrs):
+    record(name, "mark", perf_counter(), 0, **attrs)
+
+
+def _on_response(response):
+    from urllib.parse import urlparse
+
+    elapsed = response.elapsed.total_seconds()
+    url = urlparse(response.url)
+    record(f"{response.request.method} {url.path}", "api", perf_counter() - elapsed, elapsed, host=url.netloc,
+           status=response.status_code, bytes=len(response.content), thread=_thread_name())
+
+
+def _thread_name():
+    return threading.current_thread().name
+
+
+# starts a daemon thread working for this invocation, e.g. a prefetch: it only records into this invocation's
+# trace, and the trace waits for it so the requests it still has in flight are counted
+def start_thread(target, *args, name: str = None):
+    invocation = _invocation
+
+    def run():
+        _local.invocation = invocation
+        target(*args)
+
+    thread = threading.Thread(target=run, name=name, daemon=True)
+    thread.start()
+    if enabled:
+        _threads.append(thread)
+    return thread
+
+
+def begin(action: str):
+    global enabled, start, _action, _hooked, _invocation
+    enabled = True
+    _action = action or "p"
+    _invocation += 1
+    _spans.clear()
+    _threads.clear()
+    if in_daemon:
+        start = perf_counter()
+    else:
+        # everything __main__ imported before the action started
+        record("import", "startup", start, perf_counter() - start)
+
+    if not _hooked:
+        from util import request_hooks
+        request_hooks.append(_on_response)
+        _hooked = True
+
+
+def summarize(spans: list, wall: float):
+    api = [s for s in spans if s['category'] == "api"]
+    dbus = [s for s in spans if s['category'] == "dbus"]
+    rofi = [s for s in spans if s['name'] == "rofi-display"]
+    return {
+        'wall': wall,
+        'api_calls': len(api),
+        'api_time': sum(s['duration'] for s in api),
+        'api_bytes': sum(s.get('bytes', 0) for s in api),
+        'dbus_calls': len(dbus),
+        'dbus_time': sum(s['duration'] for s in dbus),
+        'time_to_rofi': rofi[0]['start'] if rofi else None,
+    }
+
+
+# writes this invocation's trace, adds it to the aggregated summary and prints both
+def end():
+    global enabled
+    from util import traces_dir, ensure_dir_exists, read_json, write_json
+
+    if not enabled:
+        return
+
+    wall = perf_counter() - start
+    while _threads:
+        _threads.pop().join()
+    enabled = False
+    summary = summarize(_spans, wall)
+    ensure_dir_exists(traces_dir)
+    write_json(traces_dir / f"{time():.3f}-{_action}.json", {'action': _action, 'summary': summary, 'spans': _spans})
+    for old_trace in sorted(traces_dir.glob("*-*.json"))[:-max_traces]:
+        old_trace.unlink()
+
+    summary_path = traces_dir / "summary.json"
+    totals = read_json(summary_path, {})
+    action_totals = totals.setdefault(_action, {'runs': 0})
+    action_totals['runs'] += 1
+    for key, value in summary.items():
+        if value is not None:
+            action_totals[key] = action_totals.get(key, 0) + value
+    write_json(summary_path, totals)
+
+    for s in sorted(_spans, key=lambda s: s['start']):
+        print(f"{s['start'] * 1000:8.1f}ms {s['duration'] * 1000:8.1f}ms  {s['category']:>7}  {s['name']}")
+    time_to_rofi = f"{summary['time_to_rofi'] * 1000:.1f}ms" if summary['time_to_rofi'] is not None else "-"
+    print(f"{_action}: {wall * 1000:.1f}ms total, {summary['api_calls']} API calls "
+          f"({summary['api_time'] * 1000:.1f}ms, {summary['api_bytes']} bytes), "
+          f"{summary['dbus_calls']} D-Bus calls ({summary['dbus_time'] * 1000:.1f}ms), rofi shown at {time_to_rofi}")
+
+    runs = action_totals['runs']
+    print(f"{_action} average over {runs} traced runs: {action_totals['wall'] / runs * 1000:.1f}ms total, "
+          f"{action_totals['api_calls'] / runs:.1f} API calls, {action_totals['dbus_calls'] / runs:.1f} D-Bus calls")
@@ -0,0 +1,100 @@
+# append-only log of plays and adds, kept next to the list it is for (favorites.txt -> favorites.log)
+# lines are "time\tevent\turi", or "time\tscore\turi\tvalue" for a score carried over by compaction
+# an item's frecency is the sum of its event weights, each halving every half_life seconds
+# scores are kept as sum(weight * 2 ** ((time - epoch) / half_life)), which orders items like the decayed score
+# at any later time does, so an event only ever adds to one score and the log is never replayed to update it
+import os
+from pathlib import Path
+from time import time
+
+weights = {"play": 1.0, "add": 0.5}
+half_life = 14 * 24 * 60 * 60
+# events appended before the log is rewritten with one score line per item
+max_events = 1000
+
+
+class UsageLog:
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.scores = {}
+        self.epoch = None
+        self.events = 0
+        # how far the log has been read, and which file it was, since compaction replaces it
+        self._offset = 0
+        self._inode = None
+
+    def _reset(self, inode=None):
+        self.scores.clear()
+        self.epoch = None
+        self.events = 0
+        self._offset = 0
+        self._inode = inode
+
+    def _apply(self, line: str):
+        fields = line.split("\t")
+        try:
+            at = float(fields[0])
+            weight = float(fields[3]) if fields[1] == "score" else weights[fields[1]]
+            uri = fields[2]
+        except (IndexError, KeyError, ValueError):
+            # skip lines this version doesn't know
+            return
+        if self.epoch is None:
+            self.epoch = at
+        self.scores[uri] = self.scores.get(uri, 0) + weight * 2 ** ((at - self.epoch) / half_life)
+        if fields[1] != "score":
+            self.events += 1
+
+    # reads lines appended since the last read, returns whether any scores changed
+    def refresh(self):
+        try:
+            stat = self.path.stat()
+        except FileNotFoundError:
+            changed = bool(self.scores)
+            self._reset()
+            return changed
+
+        changed = False
+        if stat.st_ino != self._inode or stat.st_size < self._offset:
+            # compacted since the last read
+            changed = bool(self.scores)
+            self._reset(stat.st_ino)
+        if stat.st_size == self._offset:
+            return changed
+
+        with self.path.open("rb") as f:
+            f.seek(self._offset)
+            data = f.read()
+        # a line still being written is read next time
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].decode().splitlines():
+            self._apply(line)
+        self._offset += end
+        return changed or end > 0
+
+    # appends events as (event, uri) tuples in a single write
+    # keep: the uris still in the list, compaction forgets the rest
+    def record(self, events: list, keep=None):
+        now = time()
+        with self.path.open("a") as f:
+            f.write("".join(f"{now:.3f}\t{event}\t{uri}\n" for event, uri in events))
+        # also picks up events appended by other processes
+        self.refresh()
+        if self.events > max_events:
+            self.compact(keep)
+
+    # rewrites the log as one line per uri holding its decayed score, events appended by another process
+    # between reading and replacing the log are lost
+    def compact(self, keep=None):
+        self.refresh()
+        now = time()
+        scores = sorted(((uri, score) for uri, score in self.scores.items() if keep is None or uri in keep),
+                        key=lambda entry: -entry[1])
+        decay = 2 ** ((self.epoch - now) / half_life) if self.epoch is not None else 1
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with tmp_path.open("w") as f:
+            f.writelines(f"{now:.3f}\tscore\t{uri}\t{score * decay!r}\n" for uri, score in scores)
+        os.replace(tmp_path, self.path)
+        self._reset()
+        self.refresh()
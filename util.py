@@ -1,5 +1,6 @@
 from configparser import ConfigParser
 from pathlib import Path
+from threading import Lock
 
 cache_dir = Path.home() / ".cache" / "play-menu"
 config_dir = Path.home() / ".config" / "play-menu"
@@ -11,11 +12,59 @@ file_delim = '\t'
 
 config_file: Path = config_dir / "play-menu.conf"
 oauth_file = cache_dir / "auth.json"
+playlist_index_dir = cache_dir / "playlists"
+daemon_socket = cache_dir / "daemon.sock"
+saved_tracks_file = cache_dir / "saved_tracks.json"
+metadata_cache_file = cache_dir / "metadata.db"
+thumbs_dir = cache_dir / "thumbs"
+thumbs_db_file = cache_dir / "thumbs.db"
+catalogue_file = cache_dir / "catalogue.db"
+search_index_file = cache_dir / "search.db"
+web_searches_file = cache_dir / "web_searches.db"
+search_locks_dir = cache_dir / "search_locks"
+# the current track and context, kept up to date by a running MPRIS watcher
+player_state_file = cache_dir / "player.json"
+# held by the running watcher, so the state is only trusted while its writer is alive
+player_lock_file = cache_dir / "player.lock"
+traces_dir = cache_dir / "traces"
+# seconds before the local mirror of saved tracks is checked against the user's library again
+saved_tracks_reconcile_interval = 60 * 60
 
 img_ext = "jpg"
 img_res = (64, 64)
+# concurrent downloads and per-download timeout (seconds) used when prefetching menu images
+img_fetch_workers = 8
+img_fetch_timeout = 10
+# icon theme icon shown in menus for items whose image isn't cached yet
+placeholder_icon = "audio-x-generic"
+# default size budget for cached thumbnails, overridable with max_bytes/max_files in the [Cache] config section
+thumbs_max_bytes = 64 * 2 ** 20
+thumbs_max_files = 10000
+# thumbnail sizes in px, overridable with thumb_sizes (e.g. "64 128") in the [Cache] section, menus show the first
+thumb_sizes = str(img_res[0])
+# concurrent Web API requests made by the asyncio client, overridable with max_concurrency in the [Api] section
+api_max_concurrency = 8
+# the access token is refreshed in the background once it is this many seconds from expiring
+token_refresh_margin = 5 * 60
+# spotipy refreshes a token itself, before the request, once it is this many seconds from expiring
+spotipy_expiry_margin = 60
+# how long the daemon waits to look again at a token left for spotipy to refresh
+token_recheck_delay = 60
+api_timeout = 5
+scopes = {"user-read-playback-state", "user-modify-playback-state", "user-follow-modify", "user-library-read",
+          "user-library-modify", "user-modify-playback-state", "playlist-modify-public", "playlist-modify-private"}
+
+# called with every Web API and OAuth response, response.elapsed is its latency including connection setup
+request_hooks = []
 
 _spotify = None
+_session = None
+# menus build the client from prefetch threads, this makes sure only one is created
+_spotify_lock = Lock()
+# background and foreground token refreshes take turns, the second one finding the token already refreshed
+_token_lock = Lock()
+_async_spotify = None
+_session_bus = None
 
 
 def ensure_dir_exists(dir_path: Path):
@@ -23,6 +72,48 @@ def ensure_dir_exists(dir_path: Path):
         dir_path.mkdir()
 
 
+def read_json(path: Path, default=None):
+    import json
+    try:
+        with path.open("r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+# writes to a temporary file first so an interrupted write never leaves a truncated cache behind
+def write_json(path: Path, data):
+    import json
+    import os
+    tmp_path = path.with_name(path.name + ".tmp")
+    with tmp_path.open("w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+# writes a cache database's pending access times (key -> time) and hit/miss counters, along with any other
+# statements (sql, params) in the same transaction, and clears accessed
+# returns False if another invocation holds the database for too long, the pending values are kept for the next flush
+def flush_accessed(db, table: str, key: str, accessed: dict, hits: int, misses: int, description: str,
+                   *statements):
+    import sqlite3
+    try:
+        db.executemany(f"UPDATE {table} SET accessed = ? WHERE {key} = ?",
+                       [(accessed_at, item) for item, accessed_at in accessed.items()])
+        for name, value in (("hits", hits), ("misses", misses)):
+            db.execute("INSERT INTO stats VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + ?",
+                       (name, value, value))
+        for sql, params in statements:
+            db.execute(sql, params)
+        db.commit()
+    except sqlite3.OperationalError as e:
+        db.rollback()
+        print(f"Could not flush the {description}: {e}")
+        return False
+    accessed.clear()
+    return True
+
+
 def get_uri_from_url(url):
     spl = url.rsplit("/", 2)
     return "spotify:{}:{}".format(spl[-2], spl[-1])
@@ -37,6 +128,16 @@ def get_config():
     return config
 
 
+# optional settings, read without prompting for credentials when there is no config file yet
+# the value is parsed as an int if the fallback is one
+def get_setting(section: str, option: str, fallback):
+    config = ConfigParser()
+    config.read(config_file)
+    if isinstance(fallback, int):
+        return config.getint(section, option, fallback=fallback)
+    return config.get(section, option, fallback=fallback)
+
+
 def gen_config(config):
     client_id = input("Enter Spotify client id: ")
     client_secret = input("Enter Spotify client secret: ")
@@ -47,70 +148,224 @@ def gen_config(config):
 
 def get_spotify():
     global _spotify
-    if not _spotify:
-        from spotipy import Spotify, SpotifyOAuth
-
-        scopes = {"user-read-playback-state", "user-modify-playback-state", "user-follow-modify", "user-library-read",
-                  "user-library-modify", "user-modify-playback-state", "playlist-modify-public",
-                  "playlist-modify-private"}
+    with _spotify_lock:
+        if not _spotify:
+            _spotify = build_spotify()
+    return _spotify
 
-        config = get_config()
-        client_id = config["Authentication"]["clientId"]
-        client_secret = config["Authentication"]["clientSecret"]
 
-        o_auth = SpotifyOAuth(client_id=client_id, client_secret=client_secret,
-                              redirect_uri="http://localhost:8080/callback", scope=" ".join(scopes),
-                              cache_path=oauth_file)
-        _spotify = Spotify(oauth_manager=o_auth)
-    return _spotify
+def build_spotify():
+    import tracing
+    with tracing.span("config and oauth load"):
+        return _build_spotify()
+
+
+def _build_spotify():
+    from spotipy import Spotify, SpotifyOAuth
+
+    config = get_config()
+    client_id = config["Authentication"]["clientId"]
+    client_secret = config["Authentication"]["clientSecret"]
+
+    session = get_session()
+    o_auth = SpotifyOAuth(client_id=client_id, client_secret=client_secret,
+                          redirect_uri="http://localhost:8080/callback", scope=" ".join(scopes),
+                          cache_path=oauth_file, requests_session=session, requests_timeout=api_timeout)
+    spotify = Spotify(oauth_manager=o_auth, requests_session=session, requests_timeout=api_timeout)
+    # lets the Web API be pointed at a local stub server
+    spotify.prefix = get_setting("Api", "prefix", spotify.prefix)
+
+    _serialize_token_refresh(o_auth)
+    schedule_token_refresh(o_auth)
+    return spotify
+
+
+# makes refresh_access_token, called by spotipy before a request and by schedule_token_refresh, run one at a time,
+# returning the cached token instead of refreshing again if another thread just did
+def _serialize_token_refresh(o_auth):
+    from time import time
+
+    refresh_access_token = o_auth.refresh_access_token
+
+    def refresh(refresh_token):
+        with _token_lock:
+            token = o_auth.cache_handler.get_cached_token()
+            if token and token['expires_at'] - time() > token_refresh_margin:
+                return token
+            return refresh_access_token(refresh_token)
+
+    o_auth.refresh_access_token = refresh
+
+
+def _on_response(response, *args, **kwargs):
+    for hook in request_hooks:
+        hook(response)
+
+
+# one keep-alive connection pool shared by the Web API client, the OAuth manager and the asyncio client
+# idempotent requests are retried on connection errors and 429/5xx responses, honouring Retry-After
+def get_session():
+    global _session
+    if not _session:
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        retry = Retry(total=3, connect=3, read=2, status=3, backoff_factor=0.3,
+                      status_forcelist=(429, 500, 502, 503, 504), respect_retry_after_header=True)
+        max_concurrency = get_setting("Api", "max_concurrency", api_max_concurrency)
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=max_concurrency, max_retries=retry)
+
+        _session = requests.Session()
+        _session.mount("https://", adapter)
+        _session.mount("http://", adapter)
+        _session.headers["Connection"] = "keep-alive"
+        _session.hooks["response"].append(_on_response)
+    return _session
+
+
+# refreshes the access token on a background thread once it is within token_refresh_margin of expiring,
+# so requests keep using the still valid token instead of waiting on the refresh
+# a token spotipy would already refresh before the next request is left to that request
+# with repeat (used by the daemon) the next refresh is scheduled after each one, for the life of the process
+def schedule_token_refresh(o_auth, repeat=False):
+    from threading import Thread, Timer
+    from time import time
+
+    token = o_auth.cache_handler.get_cached_token()
+    if not token:
+        return
+
+    def refresh():
+        current = o_auth.cache_handler.get_cached_token()
+        if current and current['expires_at'] - time() > spotipy_expiry_margin:
+            try:
+                o_auth.refresh_access_token(current['refresh_token'])
+            except Exception as e:
+                print(f"Could not refresh access token: {e}")
+        if repeat:
+            schedule_token_refresh(o_auth, repeat=True)
+
+    remaining = token['expires_at'] - time()
+    if remaining <= spotipy_expiry_margin:
+        delay = token_recheck_delay if repeat else None
+    else:
+        delay = max(remaining - token_refresh_margin, 0)
+    if delay == 0:
+        Thread(target=refresh, name="token-refresh", daemon=True).start()
+    elif repeat:
+        timer = Timer(delay, refresh)
+        timer.daemon = True
+        timer.start()
+
+
+# refreshes the access token if it is about to expire and opens a pooled connection to the Web API host,
+# so the next request pays neither (HEAD isn't an API call)
+def warm_api():
+    spotify = get_spotify()
+    spotify.auth_manager.get_access_token(as_dict=False)
+    get_session().head(spotify.prefix, timeout=api_timeout)
+
+
+def get_async_spotify():
+    global _async_spotify
+    if not _async_spotify:
+        from async_spotify import AsyncSpotify
+        _async_spotify = AsyncSpotify(get_spotify(), get_setting("Api", "max_concurrency", api_max_concurrency))
+    return _async_spotify
+
+
+# runs a coroutine from synchronous code, e.g. run_async(get_async_spotify().get_all_items(...))
+def run_async(coroutine):
+    import asyncio
+    return asyncio.run(coroutine)
+
+
+# iterates an async generator from synchronous code, on an event loop of its own that lives as long as the iteration
+def iter_async(generator):
+    import asyncio
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(generator.__anext__())
+            except StopAsyncIteration:
+                return
+    finally:
+        loop.run_until_complete(generator.aclose())
+        loop.close()
+
+
+# the bus connection is kept for the life of the process (the daemon reuses it across requests)
+def get_session_bus():
+    global _session_bus
+    if not _session_bus:
+        import dbus
+        import tracing
+        with tracing.span("SessionBus", "dbus"):
+            _session_bus = dbus.SessionBus()
+    return _session_bus
 
 
 def get_spotify_dbus_object():
-    import dbus
-    session_bus = dbus.SessionBus()
+    import tracing
     # gets spotify as a remote proxy object
-    return session_bus.get_object(
-        "org.mpris.MediaPlayer2.spotify",
-        "/org/mpris/MediaPlayer2")
+    with tracing.span("get_object", "dbus"):
+        return get_session_bus().get_object(
+            "org.mpris.MediaPlayer2.spotify",
+            "/org/mpris/MediaPlayer2")
 
 
 def play_uri(uri):
     import dbus
+    import tracing
     player_interface = dbus.Interface(get_spotify_dbus_object(), "org.mpris.MediaPlayer2.Player")
-    player_interface.OpenUri(uri)
+    with tracing.span("OpenUri", "dbus"):
+        player_interface.OpenUri(uri)
 
 
 def set_shuffle(state: bool):
     get_spotify().shuffle(state)
 
 
+# read from a running MPRIS watcher's state if there is one, otherwise asked over D-Bus
 def get_current_track():
-    import dbus
+    import mpris_watcher
     from spotify_item import Album, Track
 
-    spotify_dbus = get_spotify_dbus_object()
-    metadata = spotify_dbus.Get("org.mpris.MediaPlayer2.Player", "Metadata", dbus_interface=dbus.PROPERTIES_IFACE)
-
-    def from_metadata(key: str):
-        value = metadata[dbus.String(key)]
-        if isinstance(value, dbus.Array):
-            return [str(v) for v in value]
-        return str(value)
+    metadata = mpris_watcher.get_metadata()
+    if not metadata:
+        import dbus
+        import tracing
+        spotify_dbus = get_spotify_dbus_object()
+        with tracing.span("Get Metadata", "dbus"):
+            metadata = mpris_watcher.to_plain(spotify_dbus.Get("org.mpris.MediaPlayer2.Player", "Metadata",
+                                                               dbus_interface=dbus.PROPERTIES_IFACE))
 
-    img_url = from_metadata('mpris:artUrl')
+    img_url = metadata['mpris:artUrl']
 
-    album = Album(name=from_metadata('xesam:album'), artists=from_metadata('xesam:albumArtist'), uri=None,
-                  img_url=img_url)
-    track = Track(name=from_metadata('xesam:title'), artists=from_metadata('xesam:artist'),
-                  uri=from_metadata('mpris:trackid'), album=album, img_url=img_url)
+    album = Album(name=metadata['xesam:album'], artists=metadata['xesam:albumArtist'], uri=None, img_url=img_url)
+    track = Track(name=metadata['xesam:title'], artists=metadata['xesam:artist'], uri=metadata['mpris:trackid'],
+                  album=album, img_url=img_url)
 
+    import search_index
+    search_index.remember(track)
     return track
 
 
 # tuple(track, context)
+# the context comes from a running MPRIS watcher when it already looked it up for the current track
 def get_current_playback():
+    import mpris_watcher
     from spotify_item import SpotifyItem, Track
 
+    metadata = mpris_watcher.get_metadata()
+    if metadata:
+        context_uri = mpris_watcher.get_context_uri(metadata['mpris:trackid'])
+        if context_uri is not False:
+            track = get_current_track()
+            return track, SpotifyItem.from_uri(context_uri) if context_uri else None
+
     data = get_spotify().current_playback()
     if not data: return None, None
 
@@ -123,25 +378,47 @@ def get_current_playback():
     return item, context
 
 
-# returns the smallest image above img_res (based on width)
+# returns the smallest image above the largest thumbnail size (based on width), or the largest image if none is
 def get_best_img_from_list(images: list):
+    from thumbnails import get_sizes
     if not images: return None
     if len(images) == 1: return images[0]
-    images = filter(lambda img: img['width'] > img_res[0], images)
-    return min(images, key=lambda img: img['width'])
+    largest = max(get_sizes())
+    above = [img for img in images if img['width'] > largest]
+    if not above:
+        return max(images, key=lambda img: img['width'])
+    return min(above, key=lambda img: img['width'])
 
 
 def get_uri_type(uri: str):
     return uri.split(':')[-2]
 
 
-def save_img_url(img_url: str, img_path: Path):
-    from PIL import Image
+def download_img(img_url: str, timeout: float = img_fetch_timeout):
     from urllib import request
 
-    img = Image.open(request.urlretrieve(img_url)[0])
-    img = img.resize(img_res)
-    img.save(img_path)
+    with request.urlopen(img_url, timeout=timeout) as response:
+        return response.read()
+
+
+# decodes an image once and writes a square thumbnail for each size in paths ({size: path})
+# JPEGs are decoded at the smallest scale (1/2, 1/4 or 1/8) still covering the largest size, and every
+# thumbnail is resized from the next larger one (reduced by whole factors before resampling), returns the bytes written
+def save_thumbnails(data: bytes, paths: dict):
+    from io import BytesIO
+    from PIL import Image
+
+    img = Image.open(BytesIO(data))
+    largest = max(paths)
+    img.draft("RGB", (largest, largest))
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    written = 0
+    for size in sorted(paths, reverse=True):
+        img = img.resize((size, size), reducing_gap=2.0)
+        img.save(paths[size])
+        written += paths[size].stat().st_size
+    return written
 
 
 def add_icon_to_str(string: str, icon: str):
@@ -151,16 +428,41 @@ def add_icon_to_str(string: str, icon: str):
 def setup():
     ensure_dir_exists(config_dir)
     ensure_dir_exists(cache_dir)
+    ensure_dir_exists(playlist_index_dir)
+    ensure_dir_exists(thumbs_dir)
+    ensure_dir_exists(search_locks_dir)
 
 
-def get_args():
+def get_args(argv: list = None):
     from argparse import ArgumentParser
     parser = ArgumentParser(description="Manage Spotify using Rofi")
+    parser.add_argument("--trace", help="Record and print a latency and API call trace of this invocation",
+                        action='store_true')
+    parser.add_argument("--cache-only", help="Only use cached metadata, never call the Web API for it",
+                        action='store_true', dest="cache_only")
     subparsers = parser.add_subparsers(title="actions", dest="action")
 
     subparsers.add_parser("p", description="Open play menu", help="Open play menu")
     subparsers.add_parser("s", description="Open save menu", help="Open save menu")
     subparsers.add_parser("sp", description="Open add-to-playlist menu", help="Open add-to-playlist menu")
+    subparsers.add_parser("t", description="Open menu of the tracks in your playlists",
+                          help="Open play-track menu")
+
+    daemon_subparser = subparsers.add_parser("daemon", description="Run a resident process that serves menu requests",
+                                             help="Run menu daemon")
+    daemon_subparser.add_argument("--stop", help="Stop the running daemon", action='store_true')
+
+    watch_subparser = subparsers.add_parser("watch", description="Keep the current track and context in player.json "
+                                                                 "from MPRIS signals (the daemon does this too)",
+                                            help="Run MPRIS watcher")
+    watch_subparser.add_argument("--address", help="D-Bus address to watch instead of the session bus")
+
+    cache_subparser = subparsers.add_parser("cache", description="Show metadata and image cache statistics",
+                                            help="Show cache statistics")
+    cache_subparser.add_argument("--compact", help="Reconcile the image cache with the disk and evict it to budget",
+                                 action='store_true')
+    cache_subparser.add_argument("--warm", help="Save the images of your favorites, playlists and catalogued tracks "
+                                                "in every configured size", action='store_true')
 
     add_subparser = subparsers.add_parser("a", description="Add uri to file", help="Add uri")
 
@@ -171,15 +473,21 @@ def get_args():
     add_subparser.add_argument("uris", nargs='+',
                                help="Spotify URI, use 'context' or 'c' to add the current Spotify context")
 
-    return parser.parse_args()
+    return parser.parse_args(argv)
 
 
 def add_uri_to_file(file_path: Path, uri: str):
+    add_uris_to_file(file_path, [uri])
+
+
+# loads and writes the file once however many uris are added
+def add_uris_to_file(file_path: Path, uris: list):
     from spotify_item import Favorites
     favs = Favorites.from_file(file_path)
-    favs.add_uri(uri)
+    added = favs.add_uris(uris)
     favs.write(file_path)
-    print(f"Added {uri} to {file_path}")
+    for item in added:
+        print(f"Added {item.uri} to {file_path}")
 
 
 def notify_send(message: str, image: Path = None):
@@ -190,15 +498,19 @@ def notify_send(message: str, image: Path = None):
     subprocess.Popen(command)
 
 
-def notify_context():
+# playback: the result of get_current_playback if it was already fetched
+def notify_context(playback: tuple = None):
     from spotify_item import Track, SpotifyItem
 
     track: Track
     context: SpotifyItem
 
-    track, context = get_current_playback()
+    track, context = playback or get_current_playback()
 
     if context:
-        context.save_img()
+        import thumbnails
+        if not context.is_img_saved():
+            context.save_img()
+        thumbnails.flush()
 
     notify_send(f"Spotify context:\n{repr(context)}", image=context.get_img_path() if context else None)